@@ -1,4 +1,7 @@
 import json
+import os
+import threading
+import traceback
 
 from utils.file_utils import expand_filename
 
@@ -96,6 +99,20 @@ class ConfigNode(object):
         return 'ConfigNode(name="{_name}", value="{_value}", type="{_node_type}")'.format_map(self.__dict__)
 
 
+# flatten a (possibly nested) config dict into {'dotted.key': value}, including magic '_' node values
+def flatten_config_dict(parse_dict, prefix=''):
+    flat = {}
+    for k, v in parse_dict.items():
+        key = prefix + str(k)
+        if isinstance(v, dict):
+            if '_' in v:
+                flat[key] = v['_']
+            flat.update(flatten_config_dict({sk: sv for sk, sv in v.items() if sk != '_'}, prefix=key + '.'))
+        else:
+            flat[key] = v
+    return flat
+
+
 class ConfigManager(object):
     _instance = None
 
@@ -141,22 +158,29 @@ class ConfigManager(object):
                     if hasattr(cfg_object, src_var):
                         load_object = getattr(cfg_object, src_var)
                         if isinstance(load_object, dict):
+                            cfg_object._track_source(None, scope, load_object)
                             cls._load_dict(load_object, node=target_node)
 
+        scope = kwargs.pop('_scope', None)
         if args:
             process_args(args)
 
         if kwargs:
+            cfg_object._track_source(None, scope, kwargs)
             cls._load_dict(kwargs, node=target_node)
 
     @classmethod
     def __autoload_parse_json(cls, target_node, *args, **kwargs):
+        cfg_object = kwargs.pop('_config_object', None)
+        scope = kwargs.pop('_scope', None)
 
         def load_json_file(fn=None):
             filename = expand_filename(**kwargs, filename=fn) if fn else expand_filename(**kwargs)
             with open(filename, 'r') as json_file:
                 json_data = json.load(json_file)
-                cls._load_dict(json_data, node=target_node)
+            if cfg_object is not None:  # remember source, so that on-disk changes can be re-applied later
+                cfg_object._track_source(filename, scope, json_data)
+            cls._load_dict(json_data, node=target_node)
 
         for fn in args:
             load_json_file(fn)
@@ -185,6 +209,7 @@ class ConfigManager(object):
                     kwargs = args.pop(i)
 
             kwargs['_config_object'] = config_object
+            kwargs['_scope'] = scope
             target_node = getattr(config_object._root_node, scope) if scope else config_object._root_node
             fn_map[fn_type](target_node, *args, **kwargs)
 
@@ -213,6 +238,11 @@ class ConfigMetaRegister(type):
 class ConfigBase(metaclass=ConfigMetaRegister):
     def __init__(self):
         self._superset('_root_node', ConfigNode(name='[ROOT].{}'.format(self._config_class)))
+        self._superset('_sources', [])   # dict(filename, scope, mtime, flat) for each source, in __load__ order
+        self._superset('_watchers', {})  # key=dotted key ('' for everything), value=[callbacks]
+        self._superset('_watch_lock', threading.RLock())
+        self._superset('_watch_thread', None)
+        self._superset('_watch_stop', threading.Event())
         self._cfg_mgr._autoload_config_data(self)
 
     def _superset(self, attr, value):
@@ -238,3 +268,115 @@ class ConfigBase(metaclass=ConfigMetaRegister):
     def _load(self, *args, **kwargs):
         return self._cfg_mgr._load(*args, **kwargs)
 
+    # -------------------------------------------------------------------
+    #  Live config changes: watch a dotted key (or subtree) for changes in the __load__ JSON files
+    # -------------------------------------------------------------------
+    def _track_source(self, filename, scope, load_data):
+        """ Remembers each loaded source (filename=None for dict sources, which never change on disk). """
+        self._sources.append({'filename': filename,
+                              'scope': scope or '',
+                              'mtime': os.stat(filename).st_mtime_ns if filename else None,
+                              'flat': flatten_config_dict(load_data)})
+
+    def _merged_sources(self):
+        # later sources in __load__ override earlier ones, exactly like the initial load
+        merged = {}
+        for source in self._sources:
+            for rel_key, value in source['flat'].items():
+                merged['.'.join(filter(None, (source['scope'], rel_key)))] = value
+        return merged
+
+    def watch(self, key, callback):
+        """
+        Calls callback(key, old_value, new_value) whenever key, or any key below it, is changed by
+        check_for_changes().  key is the full dotted path from the root ('' watches everything).
+        """
+        with self._watch_lock:
+            self._watchers.setdefault(key, []).append(callback)
+        return callback
+
+    def unwatch(self, key, callback):
+        with self._watch_lock:
+            callbacks = self._watchers.get(key, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._watchers.pop(key, None)
+
+    def _notify_watchers(self, changes):
+        with self._watch_lock:
+            watchers = [(k, list(v)) for k, v in self._watchers.items()]
+        for changed_key, old_value, new_value in changes:
+            for watch_key, callbacks in watchers:
+                if not watch_key or changed_key == watch_key or changed_key.startswith(watch_key + '.'):
+                    for callback in callbacks:
+                        try:
+                            callback(changed_key, old_value, new_value)
+                        except Exception:
+                            print('*** Config: watcher {!r} failed for {!r}:'.format(callback, changed_key))
+                            traceback.print_exc()
+
+    def check_for_changes(self):
+        """
+        Re-reads any JSON source whose mtime changed, re-merges all sources in __load__ order (so a
+        changed or removed key falls back to whichever source now wins), re-applies only the merged
+        keys whose values differ, and notifies the matching watchers.  Returns a list of
+        (key, old_value, new_value) tuples.
+        """
+        changes = []
+        with self._watch_lock:
+            old_merged = self._merged_sources()
+            reloaded = False
+            for source in self._sources:
+                filename = source['filename']
+                if filename is None:
+                    continue
+                try:
+                    mtime = os.stat(filename).st_mtime_ns
+                    if mtime == source['mtime']:
+                        continue
+                    with open(filename, 'r') as json_file:
+                        new_flat = flatten_config_dict(json.load(json_file))
+                except (OSError, ValueError):
+                    continue  # missing or half-written file, so keep the old values until next check
+                source['mtime'] = mtime
+                source['flat'] = new_flat
+                reloaded = True
+
+            new_merged = self._merged_sources() if reloaded else old_merged
+            for key in sorted(set(old_merged) | set(new_merged)):
+                old_value, new_value = old_merged.get(key), new_merged.get(key)
+                if old_value == new_value and (key in old_merged) == (key in new_merged):
+                    continue
+                node = self._root_node.find_subnode(key)
+                node._superset('_value', new_value)
+                node._superset('_node_type', 1 if key in new_merged else 0)
+                changes.append((key, old_value, new_value))
+
+        if changes:
+            self._notify_watchers(changes)
+        return changes
+
+    def start_watching(self, interval=2.0):
+        """ Starts a background thread that polls the JSON sources every interval seconds. """
+        if self._watch_thread is not None:
+            return
+
+        def poll_loop():
+            while not self._watch_stop.wait(interval):
+                try:
+                    self.check_for_changes()
+                except Exception:  # keep watching, so one bad edit doesn't silently stop live config
+                    print('*** Config: check_for_changes() failed:')
+                    traceback.print_exc()
+
+        self._watch_stop.clear()
+        self._superset('_watch_thread', threading.Thread(target=poll_loop, name='config-watcher', daemon=True))
+        self._watch_thread.start()
+
+    def stop_watching(self):
+        if self._watch_thread is not None:
+            self._watch_stop.set()
+            self._watch_thread.join()
+            self._superset('_watch_thread', None)
+
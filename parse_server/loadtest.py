@@ -0,0 +1,311 @@
+#!/usr/bin/env python3.6
+# ====================================================================================================
+#  loadtest.py :: replays captured pages (eztv_raw.*.json, divia_tracker_raw.*.json) against
+#                 POST /webparser, to find the saturation point and catch throughput regressions
+# ====================================================================================================
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from glob import glob
+from itertools import count
+
+import requests
+
+from utils.capture_reader import CaptureFile, INDEX_SUFFIX
+
+DEFAULT_CAPTURES = ['../_data/eztv_raw.*.json', '../_data/divia_tracker_raw.*.json']
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+def load_captures(patterns):
+    """
+    Returns open, memory-mapped CaptureFiles (not decoded dicts), so that replaying gigabytes of
+    captures only touches the pages being sent, and resident memory stays close to constant.
+    """
+    captures = []
+    for pattern in patterns:
+        for filename in sorted(glob(pattern)):
+            if filename.endswith(INDEX_SUFFIX):
+                continue
+            capture = CaptureFile(filename)
+            if 'page_url' in capture.offsets and 'page_source' in capture.offsets:
+                captures.append(capture)
+            else:
+                capture.close()
+    return captures
+
+
+def build_payload(capture, suffix=''):
+    # splice the still JSON-escaped values straight from the mmap, so nothing is decoded or re-encoded
+    return b''.join((b'{"page_url": "', capture.raw('page_url'), b'", "page_source": "', capture.raw('page_source'),
+                     json.dumps(suffix)[1:-1].encode('utf-8'), b'"}'))
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def read_rss_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    """ Returns the pids of all descendants of pid (forkserver, plus the process-isolated parsers it forks). """
+    try:
+        import psutil
+        try:
+            return [child.pid for child in psutil.Process(pid).children(recursive=True)]
+        except psutil.Error:
+            return []
+    except ImportError:
+        pass
+
+    descendants = []
+    for children_file in glob('/proc/{}/task/*/children'.format(pid)):
+        try:
+            with open(children_file) as infile:
+                children = [int(child) for child in infile.read().split()]
+        except OSError:
+            continue  # thread (or whole process) exited
+        for child in children:
+            descendants.append(child)
+            descendants.extend(child_pids(child))
+    return descendants
+
+
+def read_tree_rss_kb(pid):
+    """ RSS of pid plus all of its descendants, so subprocess-isolated parsers are counted too. """
+    rss_kb = read_rss_kb(pid)
+    if rss_kb is None:
+        return None
+    return rss_kb + sum(read_rss_kb(child) or 0 for child in child_pids(pid))
+
+
+class LocalServer(object):
+    """
+    Runs webparser.py from a scratch copy of parse_server/, so that all of its '../_data' writes
+    (shelves, tracker segments, page cache) go to a throwaway directory instead of the real one.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8089, keep=False):
+        self.host = host
+        self.port = port
+        self.keep = keep
+        self.scratch_dir = tempfile.mkdtemp(prefix='divia_loadtest_')
+        self.proc = None
+
+    def __enter__(self):
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        work_dir = os.path.join(self.scratch_dir, 'parse_server')
+        shutil.copytree(src_dir, work_dir, ignore=shutil.ignore_patterns('__pycache__', '*.pyc'))
+        os.makedirs(os.path.join(self.scratch_dir, '_data'))
+
+        run_code = 'import bottle, webparser; bottle.run(host={!r}, port={!r}, quiet=True)'.format(self.host, self.port)
+        self.proc = subprocess.Popen([sys.executable, '-c', run_code], cwd=work_dir,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait_until_ready()
+        print('- local server pid {} on port {}, scratch dir "{}"'.format(self.proc.pid, self.port, self.scratch_dir))
+        return self
+
+    def wait_until_ready(self, timeout=30.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise Exception('LocalServer: server exited during startup (code {})'.format(self.proc.returncode))
+            try:
+                requests.get('http://{}:{}/webparser'.format(self.host, self.port), timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        raise Exception('LocalServer: server not ready after {}s'.format(timeout))
+
+    def __exit__(self, *args):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait(timeout=10)
+        if not self.keep:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+
+class LoadTest(object):
+    def __init__(self, url, captures, concurrency=4, rate=0.0, num_requests=0, duration=10.0,
+                 bust_cache=True, server_pid=None):
+        self.url = url
+        self.captures = captures
+        self.concurrency = concurrency
+        self.rate = rate                  # total requests/sec across all workers (0 = as fast as possible)
+        self.num_requests = num_requests  # stop after this many requests (0 = run for duration instead)
+        self.duration = duration
+        self.bust_cache = bust_cache      # make every page unique, so the server's page cache can't short-circuit
+        self.server_pid = server_pid
+
+        self._counter = count()
+        self._lock = threading.Lock()
+        self.latencies_ms = []
+        self.errors = {}
+        self.rss_samples = []  # (elapsed seconds, RSS kB of the server and its child processes)
+
+    def next_payload(self):
+        n = next(self._counter)
+        if self.num_requests and n >= self.num_requests:
+            return n, None
+        capture = self.captures[n % len(self.captures)]
+        return n, build_payload(capture, '<!-- loadtest {} -->'.format(n) if self.bust_cache else '')
+
+    def worker(self, start_time, stop_time):
+        session = requests.Session()
+        headers = {'Content-Type': 'application/json; charset=UTF-8'}
+        while time.time() < stop_time:
+            n, payload = self.next_payload()
+            if payload is None:
+                break
+            if self.rate:  # open-loop pacing: request n is due at start_time + n/rate
+                delay = start_time + n / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            req_start = time.perf_counter()
+            error = None
+            try:
+                response = session.post(self.url, data=payload, headers=headers, timeout=120)
+                if response.status_code != 200:
+                    error = 'HTTP {}'.format(response.status_code)
+                elif not response.json().get('success', False):
+                    error = 'success=false'
+            except requests.RequestException as e:
+                error = type(e).__name__
+            elapsed_ms = (time.perf_counter() - req_start) * 1000.0
+
+            with self._lock:
+                self.latencies_ms.append(elapsed_ms)
+                if error:
+                    self.errors[error] = self.errors.get(error, 0) + 1
+
+    def sample_rss(self, start_time, done_event, interval=1.0):
+        while not done_event.is_set():
+            rss_kb = read_tree_rss_kb(self.server_pid)
+            if rss_kb is not None:
+                self.rss_samples.append((round(time.time() - start_time, 1), rss_kb))
+            done_event.wait(interval)
+
+    def run(self):
+        start_time = time.time()
+        stop_time = start_time + self.duration if not self.num_requests else float('inf')
+        workers = [threading.Thread(target=self.worker, args=(start_time, stop_time), daemon=True)
+                   for _ in range(self.concurrency)]
+
+        done_event = threading.Event()
+        if self.server_pid:
+            threading.Thread(target=self.sample_rss, args=(start_time, done_event), daemon=True).start()
+
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        done_event.set()
+        return self.report(time.time() - start_time)
+
+    def report(self, wall_time):
+        latencies = sorted(self.latencies_ms)
+        total = len(latencies)
+        num_errors = sum(self.errors.values())
+
+        histogram, lower = {}, 0
+        for upper in HISTOGRAM_BUCKETS_MS + (float('inf'),):
+            label = '<{}ms'.format(upper) if upper != float('inf') else '>={}ms'.format(lower)
+            histogram[label] = sum(1 for v in latencies if lower <= v < upper)
+            lower = upper
+
+        return {'requests': total,
+                'concurrency': self.concurrency,
+                'target_rate': self.rate,
+                'wall_time': round(wall_time, 3),
+                'throughput': round(total / wall_time, 2) if wall_time else 0.0,
+                'error_rate': round(num_errors / total, 4) if total else 0.0,
+                'errors': self.errors,
+                'latency_ms': {'min': round(latencies[0], 2) if latencies else 0.0,
+                               'p50': round(percentile(latencies, 50), 2),
+                               'p95': round(percentile(latencies, 95), 2),
+                               'p99': round(percentile(latencies, 99), 2),
+                               'max': round(latencies[-1], 2) if latencies else 0.0},
+                'histogram': {k: v for k, v in histogram.items() if v},
+                'rss_kb': self.rss_samples}
+
+
+def print_report(results):
+    print('')
+    print('requests: {requests}  concurrency: {concurrency}  wall_time: {wall_time}s'.format_map(results))
+    print('throughput: {throughput} req/s  error_rate: {error_rate}  errors: {errors}'.format_map(results))
+    print('latency (ms): min={min}  p50={p50}  p95={p95}  p99={p99}  max={max}'.format_map(results['latency_ms']))
+    print('histogram:')
+    for label, num in results['histogram'].items():
+        print('    {:>10} {:>8}'.format(label, num))
+    if results['rss_kb']:
+        rss_values = [rss for _, rss in results['rss_kb']]
+        print('server RSS incl. children (kB): start={}  max={}  end={}'.format(rss_values[0], max(rss_values), rss_values[-1]))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Replay captured pages against POST /webparser')
+    arg_parser.add_argument('captures', nargs='*', default=DEFAULT_CAPTURES, help='capture file glob(s)')
+    arg_parser.add_argument('--url', help='target server (default: start a local server with a scratch data dir)')
+    arg_parser.add_argument('--server-pid', type=int, help='pid of --url server, to sample its RSS')
+    arg_parser.add_argument('--port', type=int, default=8089, help='port for the local server')
+    arg_parser.add_argument('-c', '--concurrency', type=int, action='append',
+                            help='concurrent clients (repeat to step up, e.g. -c 1 -c 4 -c 16 to find saturation)')
+    arg_parser.add_argument('-r', '--rate', type=float, default=0.0, help='target requests/sec (0 = unlimited)')
+    arg_parser.add_argument('-n', '--requests', type=int, default=0, help='requests per run (0 = use --duration)')
+    arg_parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds per run')
+    arg_parser.add_argument('--allow-cache-hits', action='store_true',
+                            help='replay pages unmodified, so repeats hit the server page cache')
+    arg_parser.add_argument('--keep-scratch', action='store_true', help='keep the local server scratch dir')
+    arg_parser.add_argument('--json', help='also write results to this file (for regression comparisons)')
+    args = arg_parser.parse_args(argv)
+
+    captures = load_captures(args.captures)
+    if not captures:
+        print('=> No capture files found for: {}'.format(args.captures))
+        return 1
+    print('+ Loaded {} captured pages'.format(len(captures)))
+
+    def run_steps(url, server_pid):
+        all_results = []
+        for concurrency in (args.concurrency or [4]):
+            load_test = LoadTest(url, captures, concurrency=concurrency, rate=args.rate, num_requests=args.requests,
+                                 duration=args.duration, bust_cache=not args.allow_cache_hits, server_pid=server_pid)
+            results = load_test.run()
+            print_report(results)
+            all_results.append(results)
+        return all_results
+
+    if args.url:
+        all_results = run_steps(args.url, args.server_pid)
+    else:
+        with LocalServer(port=args.port, keep=args.keep_scratch) as server:
+            all_results = run_steps('http://{}:{}/webparser'.format(server.host, server.port), server.proc.pid)
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(all_results, outfile, indent=4)
+    return 0
+
+
+# main() entry point
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import importlib
+import multiprocessing
+import os
+import re
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from utils import forkserver_prewarm
+from utils.profiling import run_profiled
+
+__all__ = ['ParserSpec', 'ParserScheduler']
+
+
+# defaults for the optional "scheduler" block of each entry in siteparsers.json
+SCHEDULER_DEFAULTS = {
+    'priority': 100,        # lower runs first (cheap handlers like divia_tracker should be lowest)
+    'timeout': 30.0,        # wall-clock seconds a handler call may take before it is abandoned (or killed)
+    'request_wait': 5.0,    # max seconds the request itself waits for it (it then finishes in the background)
+    'max_concurrency': 2,   # max in-flight calls of this handler (extra pages wait in its queue)
+    'queue_depth': 8,       # max pages waiting for a slot (only pages beyond that are dropped as "busy")
+    'isolation': 'thread',  # 'thread' or 'process' (process-isolated handlers are killed on timeout)
+    'skip_on_cache_hit': True,  # skip when the identical page was parsed recently (False for loggers)
+}
+
+
+# forking from inside a worker thread is unsafe, so subprocesses come from a clean forkserver instead
+_MP_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                         else 'spawn')
+
+
+def _run_in_subprocess(module_name, json_data, profile_path=None):
+    try:
+        handler = importlib.import_module(module_name)
+        if profile_path:
+            run_profiled(profile_path, json_data['page_url'], handler.parse_json, json_data)
+        else:
+            handler.parse_json(json_data)
+    except Exception:
+        traceback.print_exc()
+        raise SystemExit(1)
+
+
+class ParserSpec(object):
+    def __init__(self, url_match, handler, name=None, **options):
+        self.url_match = url_match
+        self.url_regex = re.compile(url_match)
+        self.handler = handler
+        self.name = name or handler.__name__
+
+        unknown = set(options) - set(SCHEDULER_DEFAULTS)
+        if unknown:
+            raise Exception('ParserSpec: Unknown scheduler option(s) for {!r}: {}'.format(self.name, sorted(unknown)))
+        for k, v in SCHEDULER_DEFAULTS.items():
+            setattr(self, k, options.get(k, v))
+        if self.isolation not in ('thread', 'process'):
+            raise Exception('ParserSpec: Invalid isolation {!r} for {!r}'.format(self.isolation, self.name))
+
+        # admits running + queued calls; the executor itself runs at most max_concurrency of them at once
+        self._slots = threading.BoundedSemaphore(self.max_concurrency + self.queue_depth)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    def __repr__(self):
+        return 'ParserSpec[ "{name}", priority={priority}, timeout={timeout}, request_wait={request_wait}, ' \
+               'max_concurrency={max_concurrency}, queue_depth={queue_depth}, isolation={isolation} ]'.format_map(self.__dict__)
+
+    def _call(self, json_data, profile_path=None):
+        try:
+            if self.isolation == 'process':
+                proc = _MP_CONTEXT.Process(target=_run_in_subprocess,
+                                           args=(self.handler.__name__, json_data, profile_path), daemon=True)
+                proc.start()
+                proc.join(self.timeout)
+                if proc.is_alive():  # hung parser: kill it, so it cannot hold its slot forever
+                    proc.terminate()
+                    proc.join()
+                    raise TimeoutError()
+                if proc.exitcode != 0:
+                    raise Exception('{} subprocess exited with code {}'.format(self.name, proc.exitcode))
+            elif profile_path:  # profile inside the worker thread, since cProfile only sees its own thread
+                run_profiled(profile_path, json_data['page_url'], self.handler.parse_json, json_data)
+            else:
+                self.handler.parse_json(json_data)
+        finally:
+            self._slots.release()
+
+    def submit(self, json_data, profile_path=None):
+        """ Returns a Future for the handler call, or None if all slots are busy and its queue is full. """
+        if not self._slots.acquire(blocking=False):
+            return None
+        return self._executor.submit(self._call, json_data, profile_path)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class ParserScheduler(object):
+    """
+    Runs the matching siteparser handlers for each page, in priority order, each on its own
+    bounded worker pool.  A slow or hung handler only ever ties up its own max_concurrency slots,
+    and the request thread never waits longer than the handler's (short) request_wait for it: the
+    call carries on in the background, and is only abandoned (or killed) after its full timeout.
+    """
+
+    def __init__(self, specs):
+        self.specs = sorted(specs, key=lambda spec: spec.priority)
+
+    @classmethod
+    def from_config(cls, config_data, siteparsers_map):
+        specs = [ParserSpec(url_match, siteparsers_map[url_match], name=handler.get('name'),
+                            **handler.get('scheduler', {}))
+                 for url_match, handler in config_data.items()]
+        return cls(specs)
+
+    def matching_specs(self, page_url):
+        return [spec for spec in self.specs if spec.url_regex.search(page_url)]
+
+    def dispatch(self, json_data, profiler=None, cache_hit=False, on_background_failure=None):
+        """
+        Submits json_data to every matching handler, then waits for each (up to its request_wait).
+        Returns a list of {'parser', 'status', 'elapsed'} dicts, where status is one of
+        'ok', 'queued' (still waiting for a slot, but will run), 'running' (still running in the
+        background), 'busy' (queue full, so dropped), 'timeout' or 'error'.  For 'queued'/'running'
+        calls that fail later, on_background_failure(parser_name) is called.  If a RequestProfiler is
+        given, each handler call is run under cProfile and its result also has the 'profile' path prefix.
+        On a page cache_hit, only the handlers with skip_on_cache_hit=False (e.g. the tracker) are run.
+        """
+        start = time.perf_counter()
+        submitted = []
+        for spec in self.matching_specs(json_data['page_url']):
+            if cache_hit and spec.skip_on_cache_hit:
+                continue
+            profile_path = profiler.profile_path(spec.handler.__name__.split('.')[-1],
+                                                 json_data['page_url']) if profiler else None
+            submitted.append((spec, profile_path, spec.submit(json_data, profile_path)))
+
+        results = []
+        for spec, profile_path, future in submitted:
+            if future is None:
+                status = 'busy'
+                print('*** Scheduler: dropped {} for "{}", all {} slots busy and {} pages queued'.format(
+                    json_data['page_url'], spec.name, spec.max_concurrency, spec.queue_depth))
+            else:
+                wait = min(spec.request_wait, spec.timeout)
+                remaining = max(0.0, wait - (time.perf_counter() - start))
+                try:
+                    future.result(timeout=remaining)
+                    status = 'ok'
+                except TimeoutError:
+                    if wait >= spec.timeout and future.running():
+                        status = 'timeout'
+                        print('*** Scheduler: "{}" timed out after {}s'.format(spec.name, spec.timeout))
+                    else:  # carries on in the background, so the page is still parsed later
+                        status = 'running' if future.running() else 'queued'
+                        future.add_done_callback(self._background_done(spec, json_data['page_url'],
+                                                                       on_background_failure))
+                except Exception:
+                    status = 'error'
+                    traceback.print_exc()
+            results.append({'parser': spec.name,
+                            'status': status,
+                            'elapsed': round(time.perf_counter() - start, 4)})
+            if profile_path and future is not None:
+                results[-1]['profile'] = profile_path
+        return results
+
+    @staticmethod
+    def _background_done(spec, page_url, on_failure):
+        def callback(future):
+            error = future.exception()
+            if error is not None:
+                print('*** Scheduler: background "{}" failed for {}: {!r}'.format(spec.name, page_url, error))
+                if on_failure:
+                    on_failure(spec.name)
+        return callback
+
+    def prewarm(self):
+        """
+        Imports (and runs the optional prewarm() hook of) every thread-isolated handler, and preloads
+        process-isolated handlers plus their PREWARM_MODULES into the forkserver, where their prewarm()
+        hooks run too, so that neither the first request nor each subprocess spawn pays the import cost.
+        """
+        preload, process_handlers = [], []
+        for spec in self.specs:
+            if spec.isolation == 'process':
+                process_handlers.append(spec.handler.__name__)
+                preload.extend(getattr(spec.handler, 'PREWARM_MODULES', []))
+            elif hasattr(spec.handler, 'prewarm'):
+                start = time.perf_counter()
+                spec.handler.prewarm()
+                print('- prewarmed "{}" in {:.1f}ms'.format(spec.name, (time.perf_counter() - start) * 1000.0))
+
+        if process_handlers and _MP_CONTEXT.get_start_method() == 'forkserver':
+            # forkserver_prewarm must come last: on import, it runs the prewarm() of the handlers named in its env var
+            os.environ[forkserver_prewarm.PREWARM_ENV] = ','.join(process_handlers)
+            preload = list(OrderedDict.fromkeys(process_handlers + preload + [forkserver_prewarm.__name__]))
+            _MP_CONTEXT.set_forkserver_preload(preload)
+            proc = _MP_CONTEXT.Process(target=int)  # start the forkserver now, rather than on first page
+            proc.start()
+            proc.join()
+
+    def start_background(self):
+        """
+        Runs the optional start_background() hook of every handler, here in the long-lived server process
+        (even for process-isolated handlers), for work that must outlive a single page, like the eztv
+        metadata enricher.
+        """
+        for spec in self.specs:
+            if hasattr(spec.handler, 'start_background'):
+                spec.handler.start_background()
+
+    def shutdown(self):
+        for spec in self.specs:
+            spec.shutdown()
@@ -3,14 +3,17 @@ import os
 
 from datetime import datetime
 
+from siteparsers.divia_tracker_store import get_tracker_store
 
-def parse_json(json_data, debug=True):
+
+def parse_json(json_data, debug=False):
     print('Divia Tracker: {} at {}'.format(json_data['page_url'], datetime.now()))
 
+    # compact activity record (timestamp, url, host, page size, page digest) instead of the full page
+    get_tracker_store().track(json_data['page_url'], json_data.get('page_source', ''))
+
     if debug:  # save output to file, to keep re-parsing during development
         filename = 'divia_tracker_raw.{}.json'.format(datetime.strftime(datetime.now(), '%Y%m%d_%H%M%S'))
         filename = os.path.join('../_data', filename)
         with open(filename, 'w') as outfile:
             json.dump(json_data, outfile)
-
-
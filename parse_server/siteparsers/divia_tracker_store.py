@@ -0,0 +1,290 @@
+import atexit
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+
+# -------------------------------------------------------------------
+#  On-disk record format (append-only segment files, one per day)
+#    header: timestamp (f64), page_size (u32), page_digest (8 bytes), host_len (u16), url_len (u16)
+#    body:   host bytes, then url bytes (both utf-8)
+# -------------------------------------------------------------------
+RECORD_HEADER = struct.Struct('<dI8sHH')
+SEGMENT_PREFIX = 'activity_'
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx.json'
+
+
+class TrackerRecord(object):
+    __slots__ = ('timestamp', 'page_size', 'page_digest', 'host', 'url')
+
+    def __init__(self, timestamp, page_size, page_digest, host, url):
+        self.timestamp = timestamp
+        self.page_size = page_size
+        self.page_digest = page_digest
+        self.host = host
+        self.url = url
+
+    def __repr__(self):
+        return 'TrackerRecord[ {} at {}, size={} ]'.format(self.url, datetime.fromtimestamp(self.timestamp),
+                                                           self.page_size)
+
+
+def pack_record(timestamp, page_size, page_digest, host, url):
+    host_bytes = host.encode('utf-8')[:0xFFFF]
+    url_bytes = url.encode('utf-8')[:0xFFFF]
+    return RECORD_HEADER.pack(timestamp, page_size, page_digest, len(host_bytes), len(url_bytes)) + host_bytes + url_bytes
+
+
+def unpack_records(buf, offset=0):
+    """ Generator that yields (offset, TrackerRecord) for each complete record in buf, starting at offset. """
+    buf_len = len(buf)
+    while offset + RECORD_HEADER.size <= buf_len:
+        timestamp, page_size, page_digest, host_len, url_len = RECORD_HEADER.unpack_from(buf, offset)
+        body_start = offset + RECORD_HEADER.size
+        body_end = body_start + host_len + url_len
+        if body_end > buf_len:
+            break  # partial record at end of segment (crash during append?), so ignore it
+        host = bytes(buf[body_start:body_start + host_len]).decode('utf-8', 'replace')
+        url = bytes(buf[body_start + host_len:body_end]).decode('utf-8', 'replace')
+        yield offset, TrackerRecord(timestamp, page_size, page_digest, host, url)
+        offset = body_end
+
+
+def record_end(buf, offset):
+    """ Returns the offset just past the (complete) record at offset. """
+    host_len, url_len = RECORD_HEADER.unpack_from(buf, offset)[3:]
+    return offset + RECORD_HEADER.size + host_len + url_len
+
+
+class SegmentIndex(object):
+    """
+    Per-segment sidecar with the per-host record offsets and hourly rollups (visits per host per hour).
+    Saved as JSON next to the segment, along with the segment size it covers, so that any records
+    appended after the last save are re-scanned on load.
+    """
+
+    def __init__(self, segment_path):
+        self.segment_path = segment_path
+        self.index_path = segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        self.segment_size = 0
+        self.host_offsets = {}  # key=host, value=[record offsets]
+        self.rollups = {}       # key=host, value={hour timestamp (as str): visit count}
+        self.is_dirty = False
+
+    def add(self, offset, record):
+        self.host_offsets.setdefault(record.host, []).append(offset)
+        hour_key = str(int(record.timestamp // 3600 * 3600))
+        host_rollup = self.rollups.setdefault(record.host, {})
+        host_rollup[hour_key] = host_rollup.get(hour_key, 0) + 1
+        self.is_dirty = True
+
+    def copy(self):
+        """ Returns a snapshot of this index, safe to read while the original keeps being appended to. """
+        index_copy = SegmentIndex(self.segment_path)
+        index_copy.segment_size = self.segment_size
+        index_copy.host_offsets = {host: list(offsets) for host, offsets in self.host_offsets.items()}
+        index_copy.rollups = {host: dict(hourly) for host, hourly in self.rollups.items()}
+        return index_copy
+
+    def load(self, read_only=False):
+        """
+        Loads the saved index, then catches up on records appended since it was saved.  The writer
+        (read_only=False) also truncates a partial record left at the end by a crash mid-append, so
+        new records are never appended after it, and saves the caught-up index.
+        """
+        try:
+            with open(self.index_path, encoding='utf-8') as infile:
+                index_data = json.load(infile)
+            self.segment_size = index_data['segment_size']
+            self.host_offsets = index_data['host_offsets']
+            self.rollups = index_data['rollups']
+        except (OSError, ValueError, KeyError):
+            self.segment_size, self.host_offsets, self.rollups = 0, {}, {}
+
+        # catch up on any records appended since the index was last saved
+        actual_size = os.path.getsize(self.segment_path) if os.path.exists(self.segment_path) else 0
+        if actual_size < self.segment_size:  # segment was truncated/replaced, so rebuild from scratch
+            self.segment_size, self.host_offsets, self.rollups = 0, {}, {}
+        if actual_size > self.segment_size:
+            with open(self.segment_path, 'rb') as seg_file:
+                buf = seg_file.read()
+            for offset, record in unpack_records(buf, self.segment_size):
+                self.add(offset, record)
+                self.segment_size = record_end(buf, offset)
+
+            if not read_only:
+                if actual_size > self.segment_size:
+                    print('*** TrackerStore: truncating {} partial bytes at end of {}'.format(
+                        actual_size - self.segment_size, self.segment_path))
+                    with open(self.segment_path, 'r+b') as seg_file:
+                        seg_file.truncate(self.segment_size)
+                self.is_dirty = True
+                self.save()
+        return self
+
+    def save(self):
+        if not self.is_dirty:
+            return
+        tmp_path = '{}.{}.{}.tmp'.format(self.index_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf-8') as outfile:
+            json.dump({'segment_size': self.segment_size,
+                       'host_offsets': self.host_offsets,
+                       'rollups': self.rollups}, outfile, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+        self.is_dirty = False
+
+
+# class to encapsulate the divia_tracker activity log
+class TrackerStore(object):
+
+    def __init__(self, dir_path='../_data/tracker', flush_every=100):
+        self.dir_path = dir_path
+        self.flush_every = flush_every  # save segment index after this many records (and at close)
+        self._lock = threading.Lock()
+        self._segment_day = None
+        self._segment_file = None
+        self._segment_index = None
+        self._unflushed = 0
+        os.makedirs(self.dir_path, exist_ok=True)
+
+    def segment_path(self, day_str):
+        return os.path.join(self.dir_path, SEGMENT_PREFIX + day_str + SEGMENT_SUFFIX)
+
+    def segment_days(self):
+        return sorted(fn[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)] for fn in os.listdir(self.dir_path)
+                      if fn.startswith(SEGMENT_PREFIX) and fn.endswith(SEGMENT_SUFFIX))
+
+    def _open_segment(self, day_str):
+        self._close_segment()
+        path = self.segment_path(day_str)
+        self._segment_index = SegmentIndex(path).load()
+        self._segment_file = open(path, 'ab')
+        self._segment_day = day_str
+
+    def _close_segment(self):
+        if self._segment_file:
+            self._segment_file.close()
+            self._segment_index.save()
+        self._segment_day = self._segment_file = self._segment_index = None
+        self._unflushed = 0
+
+    def track(self, page_url, page_source, timestamp=None):
+        """ Appends a compact record for a visited page (never the page_source itself). """
+        timestamp = timestamp or time.time()
+        source_bytes = page_source.encode('utf-8', 'surrogatepass') if isinstance(page_source, str) else page_source
+        page_digest = hashlib.blake2b(source_bytes, digest_size=8).digest()
+        host = urlsplit(page_url).hostname or ''
+        record_bytes = pack_record(timestamp, len(source_bytes), page_digest, host, page_url)
+
+        with self._lock:
+            day_str = datetime.fromtimestamp(timestamp).strftime('%Y%m%d')
+            if day_str != self._segment_day:
+                self._open_segment(day_str)
+            offset = self._segment_index.segment_size
+            self._segment_file.write(record_bytes)
+            self._segment_file.flush()
+            self._segment_index.segment_size += len(record_bytes)
+            self._segment_index.add(offset, TrackerRecord(timestamp, len(source_bytes), page_digest, host, page_url))
+
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._segment_index.save()
+                self._unflushed = 0
+
+    def flush(self):
+        with self._lock:
+            if self._segment_index:
+                self._segment_index.save()
+                self._unflushed = 0
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # -------------------------------------------------------------------
+    #  Queries
+    # -------------------------------------------------------------------
+    def _days_in_range(self, start=None, end=None):
+        start_day = datetime.fromtimestamp(start).strftime('%Y%m%d') if start else None
+        end_day = datetime.fromtimestamp(end).strftime('%Y%m%d') if end else None
+        for day_str in self.segment_days():
+            if (start_day is None or day_str >= start_day) and (end_day is None or day_str <= end_day):
+                yield day_str
+
+    def _segment_index_for(self, day_str):
+        # queries only ever read a copy (or a read-only load), never the live index track() appends to
+        with self._lock:
+            if day_str == self._segment_day:
+                return self._segment_index.copy()
+        return SegmentIndex(self.segment_path(day_str)).load(read_only=True)
+
+    def host_counts(self, start=None, end=None):
+        """
+        Returns {host: visit count} for the time range, from the hourly rollups only (no record scan),
+        so start/end are effectively rounded out to whole hours.
+        """
+        start_hour = start // 3600 * 3600 if start else None
+        counts = {}
+        for day_str in self._days_in_range(start, end):
+            for host, hourly in self._segment_index_for(day_str).rollups.items():
+                for hour_key, count in hourly.items():
+                    hour = int(hour_key)
+                    if (start_hour is None or hour >= start_hour) and (end is None or hour <= end):
+                        counts[host] = counts.get(host, 0) + count
+        return counts
+
+    def hourly_counts(self, host, start=None, end=None):
+        """ Returns {hour timestamp: visit count} for a single host, from the hourly rollups. """
+        start_hour = start // 3600 * 3600 if start else None
+        hourly_totals = {}
+        for day_str in self._days_in_range(start, end):
+            for hour_key, count in self._segment_index_for(day_str).rollups.get(host, {}).items():
+                hour = int(hour_key)
+                if (start_hour is None or hour >= start_hour) and (end is None or hour <= end):
+                    hourly_totals[hour] = hourly_totals.get(hour, 0) + count
+        return dict(sorted(hourly_totals.items()))
+
+    def iter_visits(self, host=None, start=None, end=None):
+        """
+        Generator of TrackerRecords in the exact time range, optionally for a single host
+        (which uses the per-host offsets instead of scanning every record in each segment).
+        """
+        for day_str in self._days_in_range(start, end):
+            segment_index = self._segment_index_for(day_str)
+            if host is not None and host not in segment_index.host_offsets:
+                continue
+            with open(segment_index.segment_path, 'rb') as seg_file:
+                buf = seg_file.read(segment_index.segment_size)
+
+            if host is None:
+                records = (record for _, record in unpack_records(buf))
+            else:
+                records = (next(unpack_records(buf, offset))[1] for offset in segment_index.host_offsets[host])
+
+            for record in records:
+                if (start is None or record.timestamp >= start) and (end is None or record.timestamp <= end):
+                    yield record
+
+
+_TRACKER_STORE = None
+
+
+def get_tracker_store():
+    """ Returns the shared TrackerStore, created on first use and closed at interpreter exit. """
+    global _TRACKER_STORE
+    if _TRACKER_STORE is None:
+        _TRACKER_STORE = TrackerStore()
+        atexit.register(_TRACKER_STORE.close)
+    return _TRACKER_STORE
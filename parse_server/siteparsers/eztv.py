@@ -6,11 +6,40 @@ import json
 from datetime import datetime
 from glob import glob
 
-from bs4 import BeautifulSoup
-from pyparsing import alphas, nums, alphanums, Word, Literal, CaselessLiteral, Keyword, Combine, Suppress, ParseResults
-
-from utils.string_utils import human2bytes
 from eztv_database import EZTV_Database
+from eztv_enrichment import get_enricher, get_enrichment_queue, collect_lookups, enrichment_enabled
+from table_extractor import get_plan
+from utils.capture_reader import CaptureFile
+
+
+# heavy dependencies (pyparsing) are only imported when a page is actually parsed, or at prewarm()
+PREWARM_MODULES = ['pyparsing']
+_TITLE_GRAMMAR = None
+
+
+def get_title_grammar():
+    # define pyparsing grammar (built once, then re-used for every title)
+    global _TITLE_GRAMMAR
+    if _TITLE_GRAMMAR is None:
+        from pyparsing import alphas, nums, alphanums, Word, Literal, CaselessLiteral, Keyword, Combine, Suppress
+
+        episode_index = (CaselessLiteral('S') + Word(nums) + CaselessLiteral('E') + Word(nums)).setResultsName('ep_idx')
+        res = (Keyword('720p') | Keyword('1080p')).setResultsName('res')
+        tv_source = (Keyword('HDTV') | Keyword('WEB')).setResultsName('tv_source')
+        distrib = Keyword('[eztv]').setResultsName('distrib')
+        flags = (Keyword('PROPER') | Keyword('REPACK')).setResultsName('flags')
+        ripper = Combine(Word(alphas) + Literal('264') + Literal('-') + Word(alphanums)).setResultsName('rip_source')
+        junk = '...' | CaselessLiteral('CONVERT') | CaselessLiteral('INTERNAL') | CaselessLiteral('REAL')
+        _TITLE_GRAMMAR = episode_index | res | tv_source | distrib | flags | ripper | Suppress(junk)
+    return _TITLE_GRAMMAR
+
+
+def prewarm():
+    # import heavy dependencies, compile the title grammar + extraction plan, and load the settings, before
+    # accepting traffic (for process isolation this runs in the forkserver, so each forked child inherits them)
+    get_title_grammar()
+    get_plan('https://eztv.ag/')
+    get_settings()
 
 
 def scan_episode_title(title_str, show_title):
@@ -24,25 +53,18 @@ def scan_episode_title(title_str, show_title):
     extended_info = {}
     scan_title_str = scan_title_str[len(scan_show_title)+1:]
 
-    # define pyparsing grammar
-    episode_index = (CaselessLiteral('S') + Word(nums) + CaselessLiteral('E') + Word(nums)).setResultsName('ep_idx')
-    res = (Keyword('720p') | Keyword('1080p')).setResultsName('res')
-    tv_source = (Keyword('HDTV') | Keyword('WEB')).setResultsName('tv_source')
-    distrib = Keyword('[eztv]').setResultsName('distrib')
-    flags = (Keyword('PROPER') | Keyword('REPACK')).setResultsName('flags')
-    ripper = Combine(Word(alphas) + Literal('264') + Literal('-') + Word(alphanums)).setResultsName('rip_source')
-    junk = '...' | CaselessLiteral('CONVERT') | CaselessLiteral('INTERNAL') | CaselessLiteral('REAL')
-    title_grammar = episode_index | res | tv_source | distrib | flags | ripper | Suppress(junk)
-
-    # define a parse action that updates our extended_info dictionary
-    def update_info(scan_str, pos, tokens):
+    # scan for matches, updating our extended_info dictionary and cutting each match out of the remainder
+    # (same result as transformString() with a parse action, but the shared grammar needs no per-call state)
+    from pyparsing import ParseResults
+    remainder_parts, last_end = [], 0
+    for tokens, start, end in get_title_grammar().scanString(scan_title_str):
         name = tokens.getName()
         if name:
             extended_info[name] = tokens[name]
-        return ''
-
-    title_grammar.setParseAction(update_info)
-    remainder = title_grammar.transformString(scan_title_str).strip()
+        remainder_parts.append(scan_title_str[last_end:start])
+        last_end = end
+    remainder_parts.append(scan_title_str[last_end:])
+    remainder = ''.join(remainder_parts).strip()
 
     # fix episode_index variables
     ep_idx_value = extended_info.get('ep_idx', None)
@@ -56,70 +78,43 @@ def scan_episode_title(title_str, show_title):
     return extended_info
 
 
-def parse_tvfiles_from_html(html_source):
+def parse_tvfiles_from_html(html_source, page_url='https://eztv.ag/'):
     """
     parse_tvfiles_from_html() is now a generator function to yield each line of the parsed page,
     for database handling elsewhere.  (This lets us avoid putting EZTV_Database calls in
     this function, and lets this function focus only on parsing.)
+
+    The table layout (columns, converters, date rows, title grammar) is declared in the "extract"
+    block of siteparsers.json, and run by the shared table_extractor engine in one pass.
+    """
+    site_name, plan = get_plan(page_url)
+    if plan is None:
+        raise Exception('eztv: No "extract" plan in siteparsers.json matches {!r}'.format(page_url))
+    yield from plan.iter_rows(html_source)
+
+
+_SETTINGS = None
+
+
+def get_settings():
+    """
+    Loads the config module only once (not on every request).  In the server process, values are read
+    live from the config tree, so on-disk changes picked up by the config watcher apply without a restart.
+    Process-isolated calls are forked from the forkserver, where prewarm() already loaded the settings,
+    so they see the config as of server start.
     """
-    soup = BeautifulSoup(html_source, 'html.parser')
-    save_the_date = None
-
-    def parse_date(column_data):
-        date_str =  column_data[0].b.text
-        datetime_object = datetime.strptime(date_str, '%d, %B, %Y')
-        return datetime_object
-
-    def parse_episode_line(column_data):
-        show_title = str(column_data[0].find('a').get('title'))
-        magnet_tag = column_data[2].find('a', class_='magnet')
-        tz_tag = magnet_tag.find_next_sibling('a')
-
-        fs_str = column_data[3].text
-        fs_int = 0
-        try:
-            fs_int = human2bytes(str(fs_str).strip('B'))
-        except ValueError:
-            pass
-
-        seed_str = column_data[5].text
-        num_seeds = int(seed_str.replace(',', '')) if seed_str != '-' else 0
-
-        data = {'show_title': show_title[:-8] if show_title.endswith(' Torrent') else show_title,
-                'episode_title': column_data[1].text.strip(),
-                'magnet': magnet_tag.get('href'),
-                'torrent': tz_tag.get('href') if tz_tag else None,
-                'filesize_str': fs_str,
-                'filesize_int': fs_int,
-                'seeds': num_seeds,
-                'eztv_added': save_the_date  # from outer scope
-                }
-
-        ext_info = scan_episode_title(data['episode_title'], data['show_title'])
-        if ext_info:
-            data.update(ext_info)
-
-        return data
-
-    # find H1 tag for the start of the torrent listing
-    h1_tag = soup.find('h1')
-    h1_tablerow = h1_tag.find_parent('tr')
-
-    # loop through the table rows and match only the show lines
-    for row in h1_tablerow.find_next_siblings('tr')[1:]:
-        columns = [c for c in row.contents if c != '\n']
-        if len(columns) == 1:
-            save_the_date = parse_date(columns)
-        elif len(columns) == 7:
-            episode_data = parse_episode_line(columns)
-            yield episode_data
+    global _SETTINGS
+    if _SETTINGS is None:
+        from utils.config import settings
+        settings.load_config_module('webparser', 'DevelopmentConfig')
+        _SETTINGS = settings
+    return _SETTINGS
 
 
 def parse_json(json_data, debug=True):
     print('Received EZTV page:', json_data['page_url'])
 
-    from utils.config import settings
-    settings.load_config_module('webparser', 'DevelopmentConfig')
+    settings = get_settings()
 
     if debug:  # save output to file, to keep re-parsing during development
         filename = 'eztv_raw.{}.json'.format(datetime.strftime(datetime.now(), '%Y%m%d_%H%M%S'))
@@ -128,18 +123,46 @@ def parse_json(json_data, debug=True):
             json.dump(json_data, outfile)
 
     # parse tv_file lines and add each to EZTV_Database
+    episodes = []
     with EZTV_Database(config=settings) as eztv_db:
-        for episode_data in parse_tvfiles_from_html(json_data['page_source']):
+        for episode_data in parse_tvfiles_from_html(json_data['page_source'], json_data['page_url']):
             eztv_db.add_tv_file(episode_data)
+            episodes.append(episode_data)
+
+    # metadata lookups are only queued here (never a network call during ingest); the server's
+    # background enricher resolves them and writes the results back (see start_background())
+    if enrichment_enabled(settings.SITEPARSER_eztv['tmdb_api_key']):
+        get_enrichment_queue().put(collect_lookups(episodes))
+
+
+def apply_enrichment(show_titles):
+    with EZTV_Database(config=get_settings()) as eztv_db:
+        eztv_db.apply_enrichment(get_enricher(), show_titles)
 
 
-def parse_raw_file(parse_file=None):
+def start_background():
+    # called once in the long-lived server process: start the metadata enricher (if a TMDB key is set)
+    get_enricher(api_key=get_settings().SITEPARSER_eztv['tmdb_api_key'], apply_fn=apply_enrichment)
+
+
+def parse_capture_file(capture_filename, config=None):
+    """
+    Re-parses a captured page (eztv_raw.*.json) into EZTV_Database.  The capture is memory-mapped and its
+    page_source decoded chunk by chunk straight into the extractor, so even very large captures (or a
+    replay of many of them) never hold the page, or the JSON-decoded copy of it, in memory.
+    """
+    with CaptureFile(capture_filename) as capture:
+        page_url = capture.page_url
+        print('+ Parsing page: {}'.format(page_url))
+        with EZTV_Database(config=config) as eztv_db:
+            for episode_data in parse_tvfiles_from_html(capture.iter_text('page_source'), page_url):
+                eztv_db.add_tv_file(episode_data)
+
+
+def parse_raw_file(parse_file=None, config=None):
 
     if parse_file:  # exact file specified
-        with open(parse_file, encoding='utf-8') as infile:
-            eztv_data = json.load(infile)
-            print('+ Parsing page: {}'.format(eztv_data['page_url']))
-            parse_eztv_page(eztv_data['page_source'])
+        parse_capture_file(parse_file, config=config)
 
     else:  # launch command-line prompt to ask user
 
@@ -153,10 +176,7 @@ def parse_raw_file(parse_file=None):
             for i, f in enumerate(display_list):
                 print('[{}] {}'.format(i+1, f))
             file_index = int(input('    => Select file to parse: ')) - 1  # offset for enumerate() above
-            with open(file_list[file_index], encoding='utf-8') as infile:
-                eztv_data = json.load(infile)
-                print('Parsing page: {}'.format(eztv_data['page_url']))
-                parse_eztv_page(eztv_data['page_source'])
+            parse_capture_file(file_list[file_index], config=config)
         else:
             print('=> No eztv_data files found')
 
@@ -173,7 +193,8 @@ if __name__ == '__main__':
     print('net_ifc:', get_net_interfaces())
 
     # NEW! Use as ContextManager so that it auto-closes persistent shelves
-    with EZTV_Database(config=settings) as eztv_db:
+    # (read_only, so this dump never takes the writer lock away from a running server)
+    with EZTV_Database(config=settings, read_only=True) as eztv_db:
 
         # print all tv shows-- don't use keys() because they're str().upper()
         for i, v in enumerate(eztv_db.TV_SHOWS.values(), start=1):
@@ -183,8 +204,7 @@ if __name__ == '__main__':
         for i, v in enumerate(eztv_db.TV_FILES.values(), start=1):
             print('    # {}: {}'.format(i, v))
 
-        # TODO: FIX THIS, with new generator model!
-        # TODO: [BROKEN] parse_raw_file(parse_file='../../_data/eztv_data.json')
+        # re-parsing a capture needs the writer lock, so call parse_raw_file() outside of this block
 
         # no longer needed... auto-closed by ContextManager
         # eztv_db.close()
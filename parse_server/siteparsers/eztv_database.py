@@ -1,6 +1,10 @@
+import dbm
 import json
 import os
 import shelve
+import time
+
+from utils.shelf_lock import ShelfCoordinator
 
 
 # -------------------------------------------------------------------
@@ -13,6 +17,7 @@ class TV_Show(object):
         self.episodes = {}              # key=(S01, E01), value=TV_Show_Episode
         self.is_subscribed = False      # supports TV_Show subscription (to auto-download)
         self.is_on_watchlist = False    # TODO: Flag certain shows to show in Watchlist (to *maybe* download)
+        self.tmdb_info = None           # series metadata from eztv_enrichment (id, name, first_air_date, ...)
 
     def __repr__(self):
         return 'seasons={season_set}, episodes={episodes}, subscribed={is_subscribed}'.format_map(self.__dict__)
@@ -53,6 +58,7 @@ class TV_File(object):
         self.queue_for_download = False
         self.is_downloaded = False
         self.is_deleted = False
+        self.indexed_at = time.time()   # when first added to TV_FILES (used as the watermark for exports)
 
     def __repr__(self):
         return 'TV_File[ "{filename}", res={resolution} ]'.format_map(self.__dict__)
@@ -63,16 +69,35 @@ class TV_File(object):
 # class to encapsulate all EZTV tv show logic & persistence
 class EZTV_Database(object):
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, read_only=False):
         self.settings = config
+        self.read_only = read_only  # read_only skips writeback, so iterating never caches every object in RAM
         self.dir_path = '../_data'  # MANUAL DEFINE FOR NOW
         self.TABLES = {'EZTV_DATA_OBJECTS', 'TV_SHOWS', 'TV_FILES'}
-        self.setup_databases()
+
+        # single writer across all processes; read_only instances open the latest published snapshot instead
+        self.coordinator = ShelfCoordinator(self.dir_path, ['db_' + t.lower() for t in self.TABLES])
+        self.snapshot_path = None
+        if self.read_only:
+            self.snapshot_path = self.coordinator.acquire_reader()
+        else:
+            self.coordinator.acquire_writer()
+
+        try:
+            self.setup_databases()
+        except Exception:
+            self.close(publish=False)
+            raise
 
     # helper function to streamline creation of multiple shelves
     def open_shelf(self, db_name):
         # TODO: Why are absolute paths not working???
         #dir_path = self.settings.SITEPARSER_eztv.data_dir
+        if self.read_only:
+            snapshot_file = os.path.join(self.snapshot_path, db_name)
+            if not dbm.whichdb(snapshot_file):  # nothing written yet (fresh data dir), so an empty table
+                return shelve.Shelf({}, protocol=4)
+            return shelve.open(snapshot_file, flag='r', protocol=4, writeback=False)
         return shelve.open(os.path.join(self.dir_path, db_name), protocol=4, writeback=True)
 
     def load_eztv_data_object(self, object_name, default=None):
@@ -80,7 +105,9 @@ class EZTV_Database(object):
             obj = self.EZTV_DATA_OBJECTS[object_name]
             setattr(self, object_name, obj)
         except KeyError:
-            if default:
+            if default is not None and self.read_only:
+                setattr(self, object_name, default)
+            elif default:
                 self.EZTV_DATA_OBJECTS[object_name] = default
                 setattr(self, object_name, self.EZTV_DATA_OBJECTS[object_name])
 
@@ -98,10 +125,18 @@ class EZTV_Database(object):
         self.load_eztv_data_object('shows_subscribed', default=set())
         self.load_eztv_data_object('shows_on_watchlist', default=set())
 
-    def close(self):
-        for table_name in self.TABLES:  # loop through and close() all shelves!
-            if hasattr(self, table_name) and getattr(self, table_name, None):
-                getattr(self, table_name).close()
+    def close(self, publish=True):
+        try:
+            for table_name in self.TABLES:  # loop through and close() all shelves!
+                if hasattr(self, table_name) and getattr(self, table_name, None):
+                    getattr(self, table_name).close()
+                    setattr(self, table_name, None)
+        finally:
+            # only after all shelves are synced: publish a snapshot for readers, then let the next writer in
+            if self.read_only:
+                self.coordinator.release_reader()
+            else:
+                self.coordinator.release_writer(publish=publish)
         print('- db_shelves closed')
 
     def __enter__(self):
@@ -169,6 +204,20 @@ class EZTV_Database(object):
             print('- found tv_file already previously indexed:', tv_file.filename)
             return False  # NOT created, because we found pre-existing file
 
+    def apply_enrichment(self, enricher, show_titles):
+        # copy already-cached metadata onto TV_Show/TV_Show_Episode (cache reads only, never a network call)
+        for show_title in show_titles:
+            found, show = self.find_tv_show(show_title, create_new=False)
+            show_meta = enricher.get_show_metadata(show_title) if found else None
+            if not show_meta:
+                continue
+            show.tmdb_info = show_meta
+            for (season_num, episode_num), episode in show.episodes.items():
+                if not episode.episode_title:
+                    episode_meta = enricher.get_episode_metadata(show_title, season_num, episode_num)
+                    if episode_meta and episode_meta.get('name'):
+                        episode.episode_title = episode_meta['name']
+
     def queue_tv_file_download(self, tv_file):
         with open(os.path.join(self.dir_path, 'download_queue.txt'), 'a') as queue_file:
             queue_file.write(tv_file.file_info['torrent'])
@@ -0,0 +1,335 @@
+# ====================================================================================================
+#  eztv_enrichment.py :: background TV_Show/episode metadata enrichment (via tmdbsimple), with a
+#                        persistent TTL cache so each show costs one lookup per TTL, not one per row
+#
+#  Parsers (possibly in a short-lived subprocess) only append lookups to an EnrichmentQueue file;
+#  the long-lived server process runs the ShowEnricher, which owns the cache, does the network calls,
+#  and writes the results back into EZTV_Database (under its writer lock).
+# ====================================================================================================
+import abc
+import atexit
+import fcntl
+import json
+import os
+import shelve
+import threading
+import time
+import traceback
+
+
+# -------------------------------------------------------------------
+#  Metadata clients (pluggable, so tests can use LocalMetadataClient)
+# -------------------------------------------------------------------
+class MetadataClient(abc.ABC):
+    @abc.abstractmethod
+    def search_show(self, show_title):
+        """ Returns a dict of series metadata (must include 'id'), or None if not found. """
+
+    @abc.abstractmethod
+    def get_season(self, show_id, season_num):
+        """ Returns {episode_num: dict of episode metadata} for one season, or None if not found. """
+
+
+class TMDBMetadataClient(MetadataClient):
+    def __init__(self, api_key):
+        import tmdbsimple  # only needed when enrichment is actually enabled
+        tmdbsimple.API_KEY = api_key
+        self.tmdb = tmdbsimple
+
+    def search_show(self, show_title):
+        search = self.tmdb.Search()
+        search.tv(query=show_title)
+        if not search.results:
+            return None
+        best = search.results[0]
+        return {'id': best['id'],
+                'name': best.get('name'),
+                'first_air_date': best.get('first_air_date'),
+                'overview': best.get('overview')}
+
+    def get_season(self, show_id, season_num):
+        try:
+            season_info = self.tmdb.TV_Seasons(show_id, season_num).info()
+        except Exception as e:  # tmdbsimple raises requests.HTTPError for 404
+            if getattr(getattr(e, 'response', None), 'status_code', None) == 404:
+                return None
+            raise
+        return {ep['episode_number']: {'name': ep.get('name'),
+                                       'air_date': ep.get('air_date'),
+                                       'overview': ep.get('overview')}
+                for ep in season_info.get('episodes', [])}
+
+
+class LocalMetadataClient(MetadataClient):
+    """ In-memory stand-in: shows={title: {'id': .., ...}}, seasons={(id, season): {ep: {...}}} """
+
+    def __init__(self, shows=None, seasons=None):
+        self.shows = {str(k).upper(): v for k, v in (shows or {}).items()}
+        self.seasons = seasons or {}
+        self.num_calls = 0
+
+    def search_show(self, show_title):
+        self.num_calls += 1
+        return self.shows.get(str(show_title).upper())
+
+    def get_season(self, show_id, season_num):
+        self.num_calls += 1
+        return self.seasons.get((show_id, season_num))
+
+
+# -------------------------------------------------------------------
+#  Persistent TTL cache (with negative caching of "not found" results)
+# -------------------------------------------------------------------
+class MetadataCache(object):
+    _MISSING = object()
+
+    def __init__(self, filename, ttl=7 * 86400, negative_ttl=86400):
+        self.filename = filename
+        self.ttl = ttl                    # seconds to keep found metadata
+        self.negative_ttl = negative_ttl  # seconds to remember "not found", before asking again
+        self._lock = threading.Lock()
+        self._shelf = shelve.open(filename, protocol=4)
+
+    def get(self, key, default=None):
+        """ Returns the cached value (None for a cached "not found"), or default if missing/expired. """
+        with self._lock:
+            entry = self._shelf.get(key, None)
+        if entry is None or entry[0] < time.time():
+            return default
+        return entry[1]
+
+    def has(self, key):
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def set(self, key, value):
+        expires_at = time.time() + (self.ttl if value is not None else self.negative_ttl)
+        with self._lock:
+            self._shelf[key] = (expires_at, value)
+
+    def close(self):
+        with self._lock:
+            self._shelf.close()
+
+
+def show_key(show_title):
+    return 'show:' + str(show_title).upper()
+
+
+def season_key(show_id, season_num):
+    return 'season:{}:{}'.format(show_id, season_num)
+
+
+def collect_lookups(file_infos):
+    """ Returns {show_title: set of season numbers} for parsed tv_file lines (as passed to add_tv_file). """
+    lookups = {}
+    for file_info in file_infos:
+        show_title = file_info.get('show_title')
+        if not show_title:
+            continue
+        seasons = lookups.setdefault(show_title, set())
+        ep_idx = file_info.get('ep_idx')
+        if ep_idx:
+            seasons.add(int(ep_idx[1]))
+    return lookups
+
+
+def merge_lookups(lookups, more_lookups):
+    for show_title, seasons in more_lookups.items():
+        lookups.setdefault(show_title, set()).update(seasons)
+    return lookups
+
+
+# -------------------------------------------------------------------
+#  Cross-process queue of pending lookups (an flock()'d JSON-lines file)
+# -------------------------------------------------------------------
+class EnrichmentQueue(object):
+    """
+    Parsers put() lookups with one short append (no network, no shelve), and the enricher take()s
+    everything queued so far by renaming the file away.  A work file left behind by a crashed
+    enricher is picked up again by the next take(), so queued lookups survive restarts.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_path = filename + '.lock'
+        self.work_path = filename + '.work'
+
+    def _locked(self):
+        lock_file = open(self.lock_path, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file  # closing it releases the lock
+
+    def put(self, lookups):
+        if not lookups:
+            return
+        lines = ''.join(json.dumps({'show_title': show_title, 'seasons': sorted(seasons)}) + '\n'
+                        for show_title, seasons in lookups.items()).encode('utf-8')
+        with self._locked():
+            with open(self.filename, 'a+b') as outfile:
+                if outfile.tell() and os.pread(outfile.fileno(), 1, outfile.tell() - 1) != b'\n':
+                    lines = b'\n' + lines  # previous writer was killed mid-line, so don't append onto it
+                outfile.write(lines)
+
+    def take(self):
+        """ Returns (and removes) all queued lookups, as {show_title: set of season numbers}. """
+        with self._locked():
+            if os.path.exists(self.filename) and not os.path.exists(self.work_path):
+                os.rename(self.filename, self.work_path)
+        lookups = {}
+        try:
+            with open(self.work_path, encoding='utf-8') as infile:
+                for line in infile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn line from a writer killed mid-append
+                    merge_lookups(lookups, {entry['show_title']: set(entry['seasons'])})
+        except FileNotFoundError:
+            return lookups
+        os.remove(self.work_path)
+        return lookups
+
+
+# -------------------------------------------------------------------
+#  Background enrichment worker (server process only)
+# -------------------------------------------------------------------
+class ShowEnricher(object):
+    """
+    Resolves queued (show, season) lookups on a background thread every batch_delay seconds, skipping
+    anything already cached, then calls apply_fn(show_titles) to write the (cached) metadata back
+    into the database.  Lookups (or write-backs) that fail are retried after retry_delay seconds.
+    """
+
+    def __init__(self, client, cache, queue=None, apply_fn=None, batch_delay=2.0, retry_delay=60.0):
+        self.client = client
+        self.cache = cache
+        self.queue = queue
+        self.apply_fn = apply_fn
+        self.batch_delay = batch_delay
+        self.retry_delay = retry_delay
+        self._pending = {}  # key=show_title, value=set of season numbers
+        self._failed = {}   # same, but only retried once retry_delay has passed
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='eztv-enricher', daemon=True)
+        self._thread.start()
+
+    def submit(self, lookups):
+        """ Queues {show_title: seasons} lookups in-process (parsers in other processes use the queue). """
+        with self._lock:
+            merge_lookups(self._pending, lookups)
+        self._wakeup.set()
+
+    def _needs_lookup(self, show_title, seasons):
+        show_meta = self.cache.get(show_key(show_title), MetadataCache._MISSING)
+        if show_meta is MetadataCache._MISSING:
+            return True
+        return show_meta is not None and any(not self.cache.has(season_key(show_meta['id'], season_num))
+                                             for season_num in seasons)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.batch_delay if self.queue else None)
+            if self._stop.wait(self.batch_delay if self._wakeup.is_set() else 0):  # let a page's rows collect
+                break
+            self._wakeup.clear()
+            try:
+                self.run_batch()
+            except Exception:
+                traceback.print_exc()
+
+    def run_batch(self):
+        """ Resolves everything pending (in-process plus the queue file), then applies it; returns show titles. """
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            if self._failed and time.time() >= self._retry_at:
+                batch, self._failed = merge_lookups(batch, self._failed), {}
+        if self.queue:
+            merge_lookups(batch, self.queue.take())
+        resolved, failed = [], {}
+        for show_title, seasons in batch.items():
+            try:
+                if self._needs_lookup(show_title, seasons):
+                    self.enrich_show(show_title, seasons)
+                resolved.append(show_title)
+            except Exception:
+                traceback.print_exc()
+                failed[show_title] = seasons  # leave uncached, so it is looked up again
+        if resolved and self.apply_fn:
+            try:
+                self.apply_fn(resolved)
+            except Exception:
+                traceback.print_exc()
+                merge_lookups(failed, {show_title: batch[show_title] for show_title in resolved})
+                resolved = []
+        if failed:
+            with self._lock:
+                merge_lookups(self._failed, failed)
+                self._retry_at = time.time() + self.retry_delay
+        return resolved
+
+    def enrich_show(self, show_title, seasons=()):
+        """ Looks up (or reads from cache) the show and each season; returns the show metadata or None. """
+        key = show_key(show_title)
+        show_meta = self.cache.get(key, MetadataCache._MISSING)
+        if show_meta is MetadataCache._MISSING:
+            show_meta = self.client.search_show(show_title)
+            self.cache.set(key, show_meta)
+            print('+ enrichment: show "{}" => {}'.format(show_title, show_meta['id'] if show_meta else 'NOT FOUND'))
+        if show_meta is None:
+            return None
+
+        for season_num in sorted(seasons):
+            s_key = season_key(show_meta['id'], season_num)
+            if not self.cache.has(s_key):
+                self.cache.set(s_key, self.client.get_season(show_meta['id'], season_num))
+        return show_meta
+
+    def get_show_metadata(self, show_title):
+        return self.cache.get(show_key(show_title))
+
+    def get_episode_metadata(self, show_title, season_num, episode_num):
+        show_meta = self.get_show_metadata(show_title)
+        if not show_meta:
+            return None
+        season = self.cache.get(season_key(show_meta['id'], season_num)) or {}
+        return season.get(episode_num)
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        if self.queue:  # persist unresolved lookups for the next run
+            self.queue.put(merge_lookups(self._pending, self._failed))
+        self.cache.close()
+
+
+_ENRICHER = None
+
+
+def get_enrichment_queue(dir_path='../_data'):
+    return EnrichmentQueue(os.path.join(dir_path, 'tmdb_pending.jsonl'))
+
+
+def get_enricher(api_key=None, dir_path='../_data', apply_fn=None):
+    """
+    Returns the shared ShowEnricher, or None if no TMDB API key is configured (api_key arg or the
+    TMDB_API_KEY environment variable), in which case enrichment is simply skipped.  Only call this
+    in the long-lived server process, since the enricher owns the cache shelve and its thread.
+    """
+    global _ENRICHER
+    if _ENRICHER is None:
+        api_key = api_key or os.getenv('TMDB_API_KEY', None)
+        if not api_key:
+            return None
+        cache = MetadataCache(os.path.join(dir_path, 'db_tmdb_cache'))
+        _ENRICHER = ShowEnricher(TMDBMetadataClient(api_key), cache, queue=get_enrichment_queue(dir_path),
+                                 apply_fn=apply_fn)
+        atexit.register(_ENRICHER.close)
+    return _ENRICHER
+
+
+def enrichment_enabled(api_key=None):
+    return bool(api_key or os.getenv('TMDB_API_KEY', None))
@@ -0,0 +1,274 @@
+# ====================================================================================================
+#  eztv_export.py :: streaming bulk export of the EZTV shelves (TV_SHOWS, TV_FILES) to NDJSON/CSV/Parquet
+# ====================================================================================================
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from contextlib import redirect_stdout
+from datetime import datetime
+
+from siteparsers.eztv_database import EZTV_Database
+
+TABLE_COLUMNS = {
+    'shows': ['show_title', 'seasons', 'num_episodes', 'is_subscribed', 'is_on_watchlist'],
+    'episodes': ['show_title', 'season', 'episode', 'episode_title', 'file_list',
+                 'is_downloaded', 'is_viewed', 'is_deleted'],
+    'files': ['filename', 'show_title', 'episode_title', 'season', 'episode', 'resolution', 'tv_source',
+              'filesize_int', 'seeds', 'eztv_added', 'magnet', 'torrent', 'queue_for_download',
+              'is_downloaded', 'is_deleted', 'indexed_at'],
+}
+EXPORT_FORMATS = ('ndjson', 'csv', 'parquet')
+
+
+# -------------------------------------------------------------------
+#  Row generators (one shelf entry in memory at a time)
+# -------------------------------------------------------------------
+def iter_shows(eztv_db, shows=None):
+    show_keys = {str(s).upper() for s in shows} if shows else None
+    for key in eztv_db.TV_SHOWS.keys():
+        if show_keys is not None and key not in show_keys:
+            continue
+        show = eztv_db.TV_SHOWS[key]
+        yield {'show_title': show.show_title,
+               'seasons': sorted(show.season_set),
+               'num_episodes': len(show.episodes),
+               'is_subscribed': show.is_subscribed,
+               'is_on_watchlist': show.is_on_watchlist}
+
+
+def iter_episodes(eztv_db, shows=None):
+    show_keys = {str(s).upper() for s in shows} if shows else None
+    for key in eztv_db.TV_SHOWS.keys():
+        if show_keys is not None and key not in show_keys:
+            continue
+        show = eztv_db.TV_SHOWS[key]
+        for (season_num, episode_num), episode in sorted(show.episodes.items()):
+            yield {'show_title': show.show_title,
+                   'season': season_num,
+                   'episode': episode_num,
+                   'episode_title': episode.episode_title,
+                   'file_list': list(episode.file_list),
+                   'is_downloaded': episode.is_downloaded,
+                   'is_viewed': episode.is_viewed,
+                   'is_deleted': episode.is_deleted}
+
+
+def iter_files(eztv_db, shows=None, since=None, until=None, resolution=None, watermark=None):
+    """
+    since/until filter on the eztv_added date, resolution on the parsed '720p'/'1080p' tag, and
+    watermark on indexed_at (only files first indexed after the watermark, for incremental exports).
+    """
+    show_titles = {str(s).upper() for s in shows} if shows else None
+    for key in eztv_db.TV_FILES.keys():
+        tv_file = eztv_db.TV_FILES[key]
+        info = tv_file.file_info
+        indexed_at = getattr(tv_file, 'indexed_at', None)  # not set on files indexed before exports existed
+
+        if watermark is not None and (indexed_at is None or indexed_at <= watermark):
+            continue
+        if show_titles is not None and str(info.get('show_title')).upper() not in show_titles:
+            continue
+        eztv_added = info.get('eztv_added')
+        if (since or until) and eztv_added is None:
+            continue
+        if (since and eztv_added < since) or (until and eztv_added > until):
+            continue
+        file_res = tv_file.resolution or info.get('res')
+        if resolution and file_res != resolution:
+            continue
+
+        ep_idx = info.get('ep_idx')
+        yield {'filename': tv_file.filename,
+               'show_title': info.get('show_title'),
+               'episode_title': info.get('episode_title'),
+               'season': int(ep_idx[1]) if ep_idx else None,
+               'episode': int(ep_idx[3]) if ep_idx else None,
+               'resolution': file_res,
+               'tv_source': info.get('tv_source'),
+               'filesize_int': info.get('filesize_int'),
+               'seeds': info.get('seeds'),
+               'eztv_added': eztv_added,
+               'magnet': info.get('magnet'),
+               'torrent': info.get('torrent'),
+               'queue_for_download': tv_file.queue_for_download,
+               'is_downloaded': tv_file.is_downloaded,
+               'is_deleted': tv_file.is_deleted,
+               'indexed_at': indexed_at}
+
+
+def iter_table(eztv_db, table, **filters):
+    if table == 'shows':
+        return iter_shows(eztv_db, shows=filters.get('shows'))
+    elif table == 'episodes':
+        return iter_episodes(eztv_db, shows=filters.get('shows'))
+    elif table == 'files':
+        return iter_files(eztv_db, **filters)
+    raise Exception('eztv_export: Unknown table {!r}, expected one of {}'.format(table, sorted(TABLE_COLUMNS)))
+
+
+# -------------------------------------------------------------------
+#  Writers
+# -------------------------------------------------------------------
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, tuple, set)):
+        return json.dumps(sorted(value) if isinstance(value, set) else list(value))
+    return value
+
+
+def stream_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, default=_json_default) + '\n'
+
+
+def stream_csv(rows, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_csv_value(row.get(c)) for c in columns])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()  # header only, if there were no rows
+
+
+def write_parquet(rows, columns, filename, batch_size=10000):
+    """ Writes rows in batch_size row groups, so memory use stays constant (requires pyarrow). """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('eztv_export: parquet format requires pyarrow (pip install pyarrow)')
+
+    writer = None
+    batch = []
+
+    def flush_batch():
+        nonlocal writer
+        table = pyarrow.Table.from_pydict({c: [_csv_value(row.get(c)) for row in batch] for c in columns})
+        if writer is None:  # columns that are all None in the first batch are assumed to be strings
+            schema = pyarrow.schema([f.with_type(pyarrow.string()) if pyarrow.types.is_null(f.type) else f
+                                     for f in table.schema])
+            writer = pyarrow.parquet.ParquetWriter(filename, schema)
+        writer.write_table(table.cast(writer.schema))
+        batch.clear()
+
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush_batch()
+        if batch or writer is None:
+            flush_batch()
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def max_watermark(rows, state):
+    """ Passes rows through, while tracking the highest indexed_at seen in state['watermark']. """
+    for row in rows:
+        indexed_at = row.get('indexed_at')
+        if indexed_at is not None and (state['watermark'] is None or indexed_at > state['watermark']):
+            state['watermark'] = indexed_at
+        yield row
+
+
+def stream_table(table, fmt, eztv_db=None, state=None, **filters):
+    """
+    Generator of ndjson/csv text chunks for one table, opening (and finally closing) a read-only
+    EZTV_Database if none is given.  If a state dict is given, state['watermark'] is updated to the
+    highest indexed_at exported, for the next incremental export.
+    """
+    if fmt not in ('ndjson', 'csv'):
+        raise Exception('eztv_export: Cannot stream format {!r}, expected ndjson or csv'.format(fmt))
+    state = state if state is not None else {}
+    state.setdefault('watermark', filters.get('watermark'))
+
+    close_db = eztv_db is None
+    eztv_db = eztv_db or EZTV_Database(read_only=True)
+    try:
+        rows = max_watermark(iter_table(eztv_db, table, **filters), state)
+        yield from stream_ndjson(rows) if fmt == 'ndjson' else stream_csv(rows, TABLE_COLUMNS[table])
+    finally:
+        if close_db:
+            eztv_db.close()
+
+
+def export_table(table, fmt, outfile=None, filename=None, **filters):
+    """
+    Exports one table.  ndjson/csv are streamed to outfile (a text file object); parquet needs a filename.
+    Returns the new watermark (highest indexed_at exported), for the next incremental export.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise Exception('eztv_export: Unknown format {!r}, expected one of {}'.format(fmt, EXPORT_FORMATS))
+
+    state = {'watermark': filters.get('watermark')}
+    if fmt == 'parquet':
+        eztv_db = EZTV_Database(read_only=True)
+        try:
+            write_parquet(max_watermark(iter_table(eztv_db, table, **filters), state), TABLE_COLUMNS[table], filename)
+        finally:
+            eztv_db.close()
+    else:
+        for chunk in stream_table(table, fmt, state=state, **filters):
+            outfile.write(chunk)
+    return state['watermark']
+
+
+def parse_date(date_str):
+    return datetime.strptime(date_str, '%Y-%m-%d') if date_str else None
+
+
+# main() entry point, run from parse_server/ as:  python -m siteparsers.eztv_export files --format csv
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Export the EZTV database')
+    arg_parser.add_argument('table', choices=sorted(TABLE_COLUMNS))
+    arg_parser.add_argument('-f', '--format', choices=EXPORT_FORMATS, default='ndjson')
+    arg_parser.add_argument('-o', '--output', help='output file (default: stdout, not allowed for parquet)')
+    arg_parser.add_argument('--show', action='append', help='only this show (may be repeated)')
+    arg_parser.add_argument('--since', help='eztv_added on/after YYYY-MM-DD (files only)')
+    arg_parser.add_argument('--until', help='eztv_added on/before YYYY-MM-DD (files only)')
+    arg_parser.add_argument('--resolution', help='e.g. 720p or 1080p (files only)')
+    arg_parser.add_argument('--watermark-file', help='incremental export: only files indexed after the watermark '
+                                                     'saved in this file, then save the new watermark (files only)')
+    args = arg_parser.parse_args()
+
+    filters = {'shows': args.show}
+    if args.table == 'files':
+        filters.update(since=parse_date(args.since), until=parse_date(args.until), resolution=args.resolution)
+        if args.watermark_file and os.path.exists(args.watermark_file):
+            with open(args.watermark_file) as wm_file:
+                filters['watermark'] = float(wm_file.read().strip() or 0) or None
+
+    if args.format == 'parquet' and not args.output:
+        arg_parser.error('parquet format requires --output')
+
+    # EZTV_Database prints its status, which must not end up in an export streamed to stdout
+    export_stdout = sys.stdout
+    with redirect_stdout(sys.stderr):
+        if args.format == 'parquet':
+            new_watermark = export_table(args.table, args.format, filename=args.output, **filters)
+        elif args.output:
+            with open(args.output, 'w', encoding='utf-8', newline='') as outfile:
+                new_watermark = export_table(args.table, args.format, outfile=outfile, **filters)
+        else:
+            new_watermark = export_table(args.table, args.format, outfile=export_stdout, **filters)
+
+    if args.watermark_file and new_watermark is not None:
+        with open(args.watermark_file, 'w') as wm_file:
+            wm_file.write(repr(new_watermark))
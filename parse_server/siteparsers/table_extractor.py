@@ -0,0 +1,374 @@
+# ====================================================================================================
+#  table_extractor.py :: declarative table-extraction engine for siteparsers
+#
+#  A site's "extract" block in siteparsers.json is compiled once into an ExtractionPlan, which then
+#  pulls rows out of a page in a single streaming pass (stdlib html.parser, no DOM tree built):
+#
+#    "extract": {
+#      "anchor": "h1",                 # rows are the <tr>s following the row that contains this tag
+#      "skip_rows": 1,                 # ...minus this many header rows
+#      "row_kinds": {                  # keyed by number of cells in the row
+#        "1": {"context": {"added": {"column": 0, "select": "b", "convert": ["date:%d, %B, %Y"]}}},
+#        "7": {"fields": {"title": {"column": 1, "convert": ["strip"]},
+#                         "link":  {"column": 2, "select": "a.magnet + a", "attr": "href"}}}
+#      },
+#      "title_grammar": {"field": "title", "tokens": {"res": "\\b(720p|1080p)\\b"}}
+#    }
+#
+#  "context" fields are carried forward onto every following data row (e.g. date header rows).
+#  Selectors are "tag", "tag.class", and "sel + tag" (first tag after sel, within the same cell).
+# ====================================================================================================
+import importlib
+import json
+import os
+import re
+from datetime import datetime
+from html.parser import HTMLParser
+
+from utils.string_utils import human2bytes
+
+SITEPARSERS_CONFIG_FILE = './siteparsers/siteparsers.json'
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param',
+             'source', 'track', 'wbr'}
+
+
+# -------------------------------------------------------------------
+#  Converters: "name" or "name:arg", applied in order to the extracted string
+# -------------------------------------------------------------------
+def _to_int(value):
+    value = str(value).strip().replace(',', '')
+    return 0 if value in ('', '-') else int(value)
+
+
+CONVERTERS = {
+    'strip': lambda arg: lambda v: v.strip(arg or None),
+    'strip_suffix': lambda arg: lambda v: v[:-len(arg)] if arg and v.endswith(arg) else v,
+    'strip_prefix': lambda arg: lambda v: v[len(arg):] if arg and v.startswith(arg) else v,
+    'int': lambda arg: _to_int,
+    'float': lambda arg: lambda v: float(str(v).strip().replace(',', '')),
+    'human2bytes': lambda arg: lambda v: human2bytes(str(v).strip(arg or 'B')),
+    'date': lambda arg: lambda v: datetime.strptime(str(v).strip(), arg),
+    'lower': lambda arg: lambda v: v.lower(),
+    'upper': lambda arg: lambda v: v.upper(),
+}
+
+
+def compile_converters(names):
+    chain = []
+    for name in names or []:
+        conv_name, _, arg = name.partition(':')
+        if conv_name not in CONVERTERS:
+            raise Exception('table_extractor: Unknown converter {!r}'.format(name))
+        chain.append(CONVERTERS[conv_name](arg))
+    return chain
+
+
+# -------------------------------------------------------------------
+#  Streaming row scanner
+# -------------------------------------------------------------------
+class Cell(object):
+    __slots__ = ('text_parts', 'elements')
+
+    def __init__(self):
+        self.text_parts = []
+        self.elements = []  # [tag, attrs, text_parts] for each element inside the cell, in document order
+
+    @property
+    def text(self):
+        return ''.join(self.text_parts)
+
+
+class _RowScanner(HTMLParser):
+    """ Collects the cells of each <tr> following the anchor row, in the same table as the anchor. """
+
+    def __init__(self, anchor=None):
+        super().__init__(convert_charrefs=True)
+        self.anchor = anchor
+        self.rows = []              # completed rows (each a list of Cells), drained by the caller
+        self.done = False
+        self._table_depth = 0
+        self._rows_depth = None     # table depth whose <tr>s are rows (set once the anchor is found)
+        self._in_anchor_row = False
+        self._row = None
+        self._cell = None
+        self._open = []             # elements open inside the current cell
+
+    def _close_cell(self):
+        if self._cell is not None:
+            self._row.append(self._cell)
+        self._cell = None
+        self._open = []
+
+    def _close_row(self):
+        self._close_cell()
+        if self._row is not None and not self._in_anchor_row:
+            self.rows.append(self._row)
+        self._row = None
+        self._in_anchor_row = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'table':
+            self._table_depth += 1
+        is_structural = self._rows_depth is not None and self._table_depth == self._rows_depth
+
+        if self._rows_depth is None:
+            if tag == (self.anchor or 'table'):  # found anchor, so its table's rows come next
+                self._rows_depth = self._table_depth
+                self._in_anchor_row = bool(self.anchor)
+                self._row = [] if self.anchor else None
+        elif is_structural and tag == 'tr':
+            self._close_row()
+            self._row = []
+        elif is_structural and tag in ('td', 'th') and self._row is not None:
+            self._close_cell()
+            self._cell = Cell()
+        elif self._cell is not None:
+            element = [tag, dict(attrs), []]
+            self._cell.elements.append(element)
+            if tag not in VOID_TAGS:
+                self._open.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        if self._cell is not None and not self.done:
+            self._cell.elements.append([tag, dict(attrs), []])
+
+    def handle_endtag(self, tag):
+        if self.done or self._rows_depth is None:
+            if tag == 'table':
+                self._table_depth -= 1
+            return
+        is_structural = self._table_depth == self._rows_depth
+        if tag == 'table':
+            if is_structural:  # end of the anchor's table
+                self._close_row()
+                self.done = True
+            self._table_depth -= 1
+        elif is_structural and tag == 'tr':
+            self._close_row()
+        elif is_structural and tag in ('td', 'th'):
+            self._close_cell()
+        elif self._open:
+            for i in range(len(self._open) - 1, -1, -1):
+                if self._open[i][0] == tag:
+                    del self._open[i:]
+                    break
+
+    def handle_data(self, data):
+        if self._cell is not None and not self.done:
+            self._cell.text_parts.append(data)
+            for element in self._open:
+                element[2].append(data)
+
+    def close(self):
+        super().close()
+        if not self.done:
+            self._close_row()
+
+
+# -------------------------------------------------------------------
+#  Compiled plan
+# -------------------------------------------------------------------
+def compile_selector(selector):
+    """ Returns a function(cell) => matching [tag, attrs, text_parts] element or None. """
+    steps = []
+    for part in [p.strip() for p in selector.split('+')]:
+        tag, _, css_class = part.partition('.')
+        steps.append((tag.lower(), css_class))
+
+    def select(cell):
+        start = 0
+        match = None
+        for tag, css_class in steps:
+            match = None
+            for i in range(start, len(cell.elements)):
+                el_tag, el_attrs, _ = cell.elements[i]
+                if el_tag == tag and (not css_class or css_class in (el_attrs.get('class') or '').split()):
+                    match, start = cell.elements[i], i + 1
+                    break
+            if match is None:
+                return None
+        return match
+
+    return select
+
+
+class FieldSpec(object):
+    def __init__(self, name, column, select=None, attr=None, convert=None, default=None):
+        self.name = name
+        self.column = column
+        self.select = compile_selector(select) if select else None
+        self.attr = attr
+        self.converters = compile_converters(convert)
+        self.default = default
+
+    def extract(self, cells):
+        if self.column >= len(cells):
+            return self.default
+        cell = cells[self.column]
+        if self.select:
+            element = self.select(cell)
+            if element is None:
+                return self.default
+            value = element[1].get(self.attr) if self.attr else ''.join(element[2])
+        else:
+            value = cell.text
+        if value is None:
+            return self.default
+        try:
+            for convert in self.converters:
+                value = convert(value)
+        except ValueError:
+            return self.default
+        return value
+
+
+def compile_fields(field_config):
+    return [FieldSpec(name, **spec) for name, spec in (field_config or {}).items()]
+
+
+class TitleGrammar(object):
+    """
+    Either "tokens" (named regexes, compiled into one alternation and scanned left to right: each match
+    sets its name to the single group, or the list of groups, or the whole match), or "function"
+    ("module:function", called as function(title, prefix) and returning a dict).  The title is taken
+    from "field", minus the value of "prefix_field" if given.  Unmatched leftovers go in "_extra".
+    """
+
+    def __init__(self, field, tokens=None, function=None, prefix_field=None):
+        self.field = field
+        self.prefix_field = prefix_field
+        self.function = None
+        self.token_regex = None
+        if function:
+            module_name, _, func_name = function.partition(':')
+            self.function = getattr(importlib.import_module(module_name), func_name)
+        elif tokens:
+            self.token_regex = re.compile('|'.join('(?P<{}>{})'.format(name, pattern)
+                                                   for name, pattern in tokens.items()))
+            # key=token name, value=(index of its named group, number of groups inside the token's own pattern)
+            self.token_groups = {name: (self.token_regex.groupindex[name], re.compile(pattern).groups)
+                                 for name, pattern in tokens.items()}
+
+    def scan(self, row):
+        title = row.get(self.field) or ''
+        prefix = row.get(self.prefix_field) if self.prefix_field else None
+        if self.function:
+            return self.function(title, prefix)
+
+        if prefix and title.lower().startswith(str(prefix).lower()):
+            title = title[len(prefix):]
+        info, remainder, last_end = {}, [], 0
+        for match in self.token_regex.finditer(title):
+            name = match.lastgroup
+            group_index, num_groups = self.token_groups[name]
+            groups = [match.group(group_index + i) for i in range(1, num_groups + 1)]
+            info[name] = groups[0] if num_groups == 1 else (groups if num_groups else match.group(name))
+            remainder.append(title[last_end:match.start()])
+            last_end = match.end()
+        remainder.append(title[last_end:])
+        extra = ' '.join(''.join(remainder).split())
+        if extra:
+            info['_extra'] = extra
+        return info
+
+
+class ExtractionPlan(object):
+    def __init__(self, anchor=None, skip_rows=0, row_kinds=None, title_grammar=None):
+        self.anchor = anchor
+        self.skip_rows = skip_rows
+        self.row_kinds = {}  # key=number of cells, value=(is_context, [FieldSpec])
+        for num_cells, kind in (row_kinds or {}).items():
+            if 'context' in kind:
+                self.row_kinds[int(num_cells)] = (True, compile_fields(kind['context']))
+            else:
+                self.row_kinds[int(num_cells)] = (False, compile_fields(kind.get('fields')))
+        self.title_grammar = TitleGrammar(**title_grammar) if title_grammar else None
+
+    def iter_rows(self, html_source, chunk_size=65536):
+        """
+        Generator of row dicts, scanning html_source once, chunk by chunk.  html_source is a str, or
+        any iterable of str chunks (e.g. CaptureFile.iter_text(), so the page is never held whole).
+        """
+        scanner = _RowScanner(anchor=self.anchor)
+        context = {f.name: f.default for is_context, fields in self.row_kinds.values() if is_context for f in fields}
+        rows_seen = 0
+
+        def process(raw_rows):
+            nonlocal rows_seen
+            for cells in raw_rows:
+                rows_seen += 1
+                if rows_seen <= self.skip_rows:
+                    continue
+                kind = self.row_kinds.get(len(cells))
+                if kind is None:
+                    continue
+                is_context, fields = kind
+                values = {f.name: f.extract(cells) for f in fields}
+                if is_context:
+                    context.update(values)
+                    continue
+                values.update(context)
+                if self.title_grammar:
+                    values.update(self.title_grammar.scan(values) or {})
+                yield values
+
+        chunks = html_source
+        if isinstance(html_source, str):
+            chunks = (html_source[pos:pos + chunk_size] for pos in range(0, len(html_source), chunk_size))
+        for chunk in chunks:
+            scanner.feed(chunk)
+            raw_rows, scanner.rows = scanner.rows, []
+            yield from process(raw_rows)
+            if scanner.done:
+                return
+        scanner.close()
+        yield from process(scanner.rows)
+
+
+# -------------------------------------------------------------------
+#  Plans from siteparsers.json (compiled once per process)
+# -------------------------------------------------------------------
+_PLANS = None
+
+
+def load_plans(config_file=SITEPARSERS_CONFIG_FILE):
+    global _PLANS
+    with open(config_file, encoding='utf-8') as infile:
+        config_data = json.load(infile)
+    _PLANS = [(re.compile(url_match), entry.get('name', url_match), ExtractionPlan(**entry['extract']))
+              for url_match, entry in config_data.items() if 'extract' in entry]
+    return _PLANS
+
+
+def get_plan(page_url):
+    """ Returns (site name, ExtractionPlan) for the first siteparsers.json entry matching page_url. """
+    plans = _PLANS if _PLANS is not None else load_plans()
+    for url_regex, site_name, plan in plans:
+        if url_regex.search(page_url):
+            return site_name, plan
+    return None, None
+
+
+def _json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def parse_json(json_data, debug=False):
+    """ Generic siteparser handler: extracts rows with the site's plan, and appends them as NDJSON. """
+    site_name, plan = get_plan(json_data['page_url'])
+    if plan is None:
+        print('*** table_extractor: No extract plan for', json_data['page_url'])
+        return
+
+    dir_path = os.path.join('../_data', 'extracted')
+    os.makedirs(dir_path, exist_ok=True)
+    filename = os.path.join(dir_path, re.sub(r'[^A-Za-z0-9_.-]+', '_', site_name) + '.ndjson')
+    num_rows = 0
+    with open(filename, 'a', encoding='utf-8') as outfile:
+        for row in plan.iter_rows(json_data['page_source']):
+            row['_page_url'] = json_data['page_url']
+            outfile.write(json.dumps(row, default=_json_default) + '\n')
+            num_rows += 1
+    print('{}: extracted {} rows from {}'.format(site_name, num_rows, json_data['page_url']))
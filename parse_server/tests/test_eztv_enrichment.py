@@ -0,0 +1,91 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from siteparsers.eztv_enrichment import (EnrichmentQueue, LocalMetadataClient, MetadataCache, ShowEnricher,
+                                         collect_lookups)
+
+
+class FlakyMetadataClient(LocalMetadataClient):
+    def __init__(self, *args, failures=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failures = failures
+
+    def search_show(self, show_title):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('network down')
+        return super().search_show(show_title)
+
+
+class ShowEnricherTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp(prefix='divia_enrichment_')
+        self.queue = EnrichmentQueue(os.path.join(self.dir_path, 'tmdb_pending.jsonl'))
+        self.applied = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def make_enricher(self, client, **kwargs):
+        # batch_delay is long, so that the test drives batches with run_batch() instead of the thread
+        cache = MetadataCache(os.path.join(self.dir_path, 'db_tmdb_cache'))  # closed by enricher.close()
+        return ShowEnricher(client, cache, queue=self.queue, apply_fn=self.applied.extend,
+                            batch_delay=60.0, **kwargs)
+
+    def test_queued_lookups_are_resolved_cached_and_applied(self):
+        client = LocalMetadataClient(shows={'Some Show': {'id': 7, 'name': 'Some Show'}},
+                                     seasons={(7, 2): {3: {'name': 'Pilot, Part 2'}}})
+        enricher = self.make_enricher(client)
+        try:
+            # as a parser (in any process) would queue them
+            self.queue.put(collect_lookups([{'show_title': 'Some Show', 'ep_idx': ['S', '2', 'E', '3']},
+                                            {'show_title': 'Some Show', 'ep_idx': ['S', '2', 'E', '4']},
+                                            {'show_title': 'Unknown Show', 'ep_idx': None}]))
+            self.assertEqual(sorted(enricher.run_batch()), ['Some Show', 'Unknown Show'])
+            self.assertEqual(sorted(self.applied), ['Some Show', 'Unknown Show'])
+            self.assertEqual(enricher.get_show_metadata('Some Show')['id'], 7)
+            self.assertEqual(enricher.get_episode_metadata('Some Show', 2, 3), {'name': 'Pilot, Part 2'})
+            self.assertIsNone(enricher.get_show_metadata('Unknown Show'))  # negative-cached
+            self.assertEqual(self.queue.take(), {})
+
+            # everything is cached now, so seeing the same shows again makes no client calls
+            num_calls = client.num_calls
+            self.queue.put({'Some Show': {2}, 'Unknown Show': set()})
+            enricher.run_batch()
+            self.assertEqual(client.num_calls, num_calls)
+        finally:
+            enricher.close()
+
+    def test_failed_lookups_are_retried_and_persisted(self):
+        client = FlakyMetadataClient(shows={'Some Show': {'id': 7}}, failures=1)
+        enricher = self.make_enricher(client, retry_delay=0.0)
+        try:
+            enricher.submit({'Some Show': {1}})
+            self.assertEqual(enricher.run_batch(), [])
+            self.assertEqual(enricher.run_batch(), ['Some Show'])
+            self.assertEqual(self.applied, ['Some Show'])
+        finally:
+            enricher.close()
+
+        client = FlakyMetadataClient(shows={'Some Show': {'id': 7}}, failures=1)
+        enricher = self.make_enricher(client, retry_delay=3600.0)
+        enricher.submit({'Other Show': {1}})
+        enricher.run_batch()
+        enricher.close()
+        self.assertEqual(self.queue.take(), {'Other Show': {1}})  # kept for the next run
+
+    def test_queue_skips_torn_lines(self):
+        self.queue.put({'Some Show': {1, 2}})
+        with open(self.queue.filename, 'a') as outfile:
+            outfile.write('{"show_title": "Half')
+        self.queue.put({'Some Show': {3}})
+        self.assertEqual(self.queue.take(), {'Some Show': {1, 2, 3}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import glob
+import multiprocessing
+import os
+import shelve
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.shelf_lock import ShelfCoordinator
+
+DB_NAME = 'db_test'
+
+
+def write_and_die(dir_path, key):
+    # a writer killed mid-parse (e.g. terminate()d on timeout): lock taken and shelf written, never released
+    coordinator = ShelfCoordinator(dir_path, [DB_NAME])
+    coordinator.acquire_writer()
+    with shelve.open(os.path.join(dir_path, DB_NAME), protocol=4) as shelf:
+        shelf[key] = key
+    os._exit(1)
+
+
+class ShelfCoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp(prefix='divia_shelf_lock_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def write(self, key, publish=True):
+        coordinator = ShelfCoordinator(self.dir_path, [DB_NAME], publish_interval=300.0)
+        coordinator.acquire_writer()
+        with shelve.open(os.path.join(self.dir_path, DB_NAME), protocol=4) as shelf:
+            shelf[key] = key
+        coordinator.release_writer(publish=publish)
+
+    def kill_writer(self, key):
+        proc = multiprocessing.get_context('fork').Process(target=write_and_die, args=(self.dir_path, key))
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 1)
+
+    def read_live(self):
+        coordinator = ShelfCoordinator(self.dir_path, [DB_NAME])
+        coordinator.acquire_writer()
+        try:
+            with shelve.open(os.path.join(self.dir_path, DB_NAME), flag='r', protocol=4) as shelf:
+                return sorted(shelf.keys())
+        finally:
+            coordinator.release_writer(publish=False)
+
+    def test_crash_after_unpublished_writes_keeps_clean_commits(self):
+        self.write('a', publish='force')  # published snapshot only has 'a'
+        self.write('b')
+        self.write('c')  # both within publish_interval, so not in the snapshot
+        self.kill_writer('d')
+        self.assertEqual(self.read_live(), ['a', 'b', 'c', 'd'])
+
+        # and the kept writes are still published for readers later
+        reader = ShelfCoordinator(self.dir_path, [DB_NAME], publish_interval=300.0)
+        snapshot_path = reader.acquire_reader(max_age=0)
+        try:
+            with shelve.open(os.path.join(snapshot_path, DB_NAME), flag='r', protocol=4) as shelf:
+                self.assertEqual(sorted(shelf.keys()), ['a', 'b', 'c', 'd'])
+        finally:
+            reader.release_reader()
+
+    def test_crash_with_unreadable_shelf_restores_snapshot(self):
+        self.write('a', publish='force')
+        self.write('b')
+        self.kill_writer('c')
+        for db_file in glob.glob(os.path.join(self.dir_path, DB_NAME) + '*'):
+            with open(db_file, 'wb') as outfile:
+                outfile.write(b'\x00garbage')
+        self.assertEqual(self.read_live(), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import importlib.util
+import json
+import os
+import sys
+import unittest
+
+PARSE_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(PARSE_SERVER_DIR, 'tests', 'data')
+sys.path.insert(0, PARSE_SERVER_DIR)
+sys.path.insert(0, os.path.join(PARSE_SERVER_DIR, 'siteparsers'))  # eztv uses bare sibling imports
+
+
+def normalize_rows(rows):
+    return [{k: v.isoformat() if hasattr(v, 'isoformat') else v for k, v in row.items()} for row in rows]
+
+
+@unittest.skipUnless(importlib.util.find_spec('pyparsing'), 'pyparsing is needed for the eztv title grammar')
+class EztvExtractionTest(unittest.TestCase):
+    """
+    eztv_page.expected.json is the output of the old BeautifulSoup parse_tvfiles_from_html() on
+    eztv_page.html (which has date rows, a row without a torrent link, and '-' seeds), so the
+    streaming _RowScanner must keep producing exactly the same rows.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        import eztv
+        import table_extractor
+        table_extractor.load_plans(os.path.join(PARSE_SERVER_DIR, 'siteparsers', 'siteparsers.json'))
+        cls.eztv = eztv
+        cls.table_extractor = table_extractor
+        with open(os.path.join(DATA_DIR, 'eztv_page.html'), encoding='utf-8') as infile:
+            cls.html_source = infile.read()
+        with open(os.path.join(DATA_DIR, 'eztv_page.expected.json'), encoding='utf-8') as infile:
+            cls.expected_rows = json.load(infile)
+
+    def test_matches_bs4_output(self):
+        rows = list(self.eztv.parse_tvfiles_from_html(self.html_source))
+        self.assertEqual(normalize_rows(rows), self.expected_rows)
+
+    def test_chunked_source_matches_bs4_output(self):
+        site_name, plan = self.table_extractor.get_plan('https://eztv.ag/')
+        chunks = (self.html_source[i:i + 37] for i in range(0, len(self.html_source), 37))
+        self.assertEqual(normalize_rows(plan.iter_rows(chunks)), self.expected_rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
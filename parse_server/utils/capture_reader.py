@@ -0,0 +1,200 @@
+import json
+import mmap
+import os
+import re
+from glob import glob
+
+INDEX_SUFFIX = '.idx'
+INDEXED_FIELDS = ('page_url', 'page_source')
+BACKSLASH = 0x5c
+QUOTE = 0x22
+MIN_CHUNK_SIZE = 32
+SCAN_WINDOW = 1024 * 1024  # bounded, since the regex keeps state for every escape it repeats over
+STRING_BODY_RE = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)  # JSON string contents, up to its closing quote
+HIGH_SURROGATES = (b'\\ud8', b'\\ud9', b'\\uda', b'\\udb')
+
+
+class CaptureFile(object):
+    """
+    Memory-mapped reader for a captured page file (eztv_raw.*.json, divia_tracker_raw.*.json).
+
+    Instead of json.load() of the whole file, the page_url and page_source string values are located
+    once (and the offsets saved in a small '.idx' sidecar), then handed out as zero-copy memoryview
+    slices of the still JSON-escaped bytes, or decoded incrementally in fixed-size chunks, so that
+    replaying very large captures stays at close to constant resident memory.
+    """
+
+    def __init__(self, filename, use_index_file=True):
+        self.filename = filename
+        self.use_index_file = use_index_file
+        self._file = open(filename, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        if hasattr(self._mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mm.madvise(mmap.MADV_SEQUENTIAL)
+        self.offsets = self._load_index() or self._build_index()  # key=field, value=(start, end) of raw value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            try:
+                self._mm.close()
+            except BufferError:
+                pass  # a caller still holds a raw() view, so the map is freed along with it
+        self._file.close()
+
+    def __repr__(self):
+        return 'CaptureFile["{}", {} bytes]'.format(os.path.basename(self.filename), self.size)
+
+    # -------------------------------------------------------------------
+    #  Index: offsets of each field's string value (between its quotes)
+    # -------------------------------------------------------------------
+    @property
+    def index_filename(self):
+        return self.filename + INDEX_SUFFIX
+
+    def _load_index(self):
+        if not self.use_index_file:
+            return None
+        try:
+            with open(self.index_filename, encoding='utf-8') as infile:
+                index_data = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        stat = os.stat(self.filename)
+        if index_data.get('size') != stat.st_size or index_data.get('mtime') != stat.st_mtime_ns:
+            return None  # capture changed since it was indexed
+        return {k: tuple(v) for k, v in index_data['offsets'].items()}
+
+    def _build_index(self):
+        offsets = {}
+        for field in INDEXED_FIELDS:
+            span = self._find_string_value(field)
+            if span:
+                offsets[field] = span
+
+        if self.use_index_file:
+            stat = os.stat(self.filename)
+            try:
+                with open(self.index_filename, 'w', encoding='utf-8') as outfile:
+                    json.dump({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'offsets': offsets}, outfile)
+            except OSError:
+                pass  # read-only capture dir, so just re-index next time
+        return offsets
+
+    def _find_string_value(self, field):
+        """
+        Returns (start, end) of the raw string value for "field": "...", or None.  (An unescaped
+        '"field"' can't occur inside another JSON string value, since its quotes would be escaped.)
+        """
+        mm = self._mm
+        key = json.dumps(field).encode('utf-8')
+        pos = mm.find(key)
+        while pos != -1:
+            colon = self._skip_whitespace(pos + len(key))
+            if colon < self.size and mm[colon] == ord(':'):
+                value_start = self._skip_whitespace(colon + 1)
+                if value_start < self.size and mm[value_start] == QUOTE:
+                    return value_start + 1, self._find_closing_quote(value_start + 1)
+                return None  # not a string value
+            pos = mm.find(key, pos + 1)
+        return None
+
+    def _skip_whitespace(self, pos):
+        while pos < self.size and self._mm[pos] in b' \t\r\n':
+            pos += 1
+        return pos
+
+    def _find_closing_quote(self, start):
+        # scan in windows (releasing pages behind us); each window stops at the closing quote, or at the
+        # window end (before a trailing backslash, so escapes are never split between windows)
+        pos = start
+        while pos < self.size:
+            window_end = min(pos + SCAN_WINDOW, self.size)
+            end = STRING_BODY_RE.match(self._mm, pos, window_end).end()
+            if end < window_end and self._mm[end] == QUOTE:
+                self._release(start, end)
+                return end
+            if end == pos:
+                break  # lone backslash at the end of the file
+            pos = end
+            self._release(start, pos)
+        raise Exception('CaptureFile: Unterminated string in {}'.format(self.filename))
+
+    # -------------------------------------------------------------------
+    #  Field access
+    # -------------------------------------------------------------------
+    def raw(self, field):
+        """ Zero-copy memoryview of the field's JSON-escaped bytes (without the quotes), or None. """
+        span = self.offsets.get(field)
+        return memoryview(self._mm)[span[0]:span[1]] if span else None
+
+    def text(self, field):
+        """ Fully decoded field value (a copy, so only for small fields like page_url). """
+        span = self.offsets.get(field)
+        return json.loads(b'"' + self._mm[span[0]:span[1]] + b'"') if span else None
+
+    @property
+    def page_url(self):
+        return self.text('page_url')
+
+    def iter_text(self, field='page_source', chunk_size=65536):
+        """ Generator of decoded str chunks of the field, each about chunk_size bytes of the raw value. """
+        span = self.offsets.get(field)
+        if not span:
+            return
+        chunk_size = max(chunk_size, MIN_CHUNK_SIZE)
+        mm = self._mm
+        pos, end = span
+        while pos < end:
+            cut = min(pos + chunk_size, end)
+            if cut < end:
+                cut = self._safe_cut(pos, cut)
+            yield json.loads(b'"' + mm[pos:cut] + b'"')
+            self._release(pos, cut)
+            pos = cut
+
+    def _release(self, start, end):
+        # drop already-decoded pages from this process's RSS (they're clean, so the kernel re-reads if needed)
+        if hasattr(self._mm, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+            start -= start % mmap.PAGESIZE
+            end -= end % mmap.PAGESIZE
+            if end > start:
+                self._mm.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def _is_escape_start(self, i, start):
+        backslashes = 0
+        while i - 1 - backslashes >= start and self._mm[i - 1 - backslashes] == BACKSLASH:
+            backslashes += 1
+        return self._mm[i] == BACKSLASH and backslashes % 2 == 0
+
+    def _safe_cut(self, start, cut):
+        """ Moves cut back so it never splits a UTF-8 sequence, an escape, or a \\uXXXX\\uXXXX surrogate pair. """
+        mm = self._mm
+        while 0x80 <= mm[cut] < 0xc0:  # UTF-8 continuation byte (when written with ensure_ascii=False)
+            cut -= 1
+        for i in range(cut - 6, cut):  # escapes are at most 6 bytes
+            if self._is_escape_start(i, start):
+                cut = i
+                break
+        if cut - 6 > start and mm[cut - 6:cut - 2].lower() in HIGH_SURROGATES and self._is_escape_start(cut - 6, start):
+            cut -= 6
+        return cut
+
+
+def iter_captures(patterns, use_index_file=True):
+    """ Generator of open CaptureFiles for each file matching the glob pattern(s), in sorted order. """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    for pattern in patterns:
+        for filename in sorted(glob(pattern)):
+            if filename.endswith(INDEX_SUFFIX):
+                continue
+            with CaptureFile(filename, use_index_file=use_index_file) as capture:
+                if 'page_url' in capture.offsets and 'page_source' in capture.offsets:
+                    yield capture
@@ -0,0 +1,29 @@
+import importlib
+import os
+import time
+import traceback
+
+# set by ParserScheduler.prewarm() before it starts the forkserver, which inherits the environment
+PREWARM_ENV = 'DIVIA_FORKSERVER_PREWARM'
+
+
+def prewarm_handlers(module_names):
+    """
+    Imports each handler module and runs its optional prewarm() hook.  Preloaded (as the last module)
+    into the forkserver, so that every forked subprocess starts with the handlers' grammars, plans
+    and settings already built.  Failures are only printed, since they would otherwise kill the forkserver.
+    """
+    for module_name in module_names:
+        start = time.perf_counter()
+        try:
+            handler = importlib.import_module(module_name)
+            if hasattr(handler, 'prewarm'):
+                handler.prewarm()
+        except Exception:
+            print('*** Forkserver: prewarm of {!r} failed:'.format(module_name))
+            traceback.print_exc()
+            continue
+        print('- prewarmed "{}" in forkserver in {:.1f}ms'.format(module_name, (time.perf_counter() - start) * 1000.0))
+
+
+prewarm_handlers(filter(None, os.environ.get(PREWARM_ENV, '').split(',')))
@@ -0,0 +1,77 @@
+import importlib
+import re
+import subprocess
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is only imported on first attribute access, so that heavy modules
+    (siteparsers, bs4, pyparsing) cost nothing for callers that never use them.  __name__ is
+    available without importing, which is all the parser registry/scheduler needs up front.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    @property
+    def is_loaded(self):
+        return self.__dict__['_lazy_module'] is not None
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<LazyModule {!r} ({})>'.format(self.__name__, 'loaded' if self.is_loaded else 'not loaded')
+
+
+def lazy_import(module_name):
+    """ Returns the module if it is already imported, otherwise a LazyModule placeholder for it. """
+    return sys.modules.get(module_name) or LazyModule(module_name)
+
+
+def import_time_report(module_names, top=25, python=sys.executable):
+    """
+    Imports module_names in a fresh interpreter with '-X importtime' (Python 3.7+), and returns the
+    top (cumulative_us, self_us, module) rows, most expensive first, plus the total cumulative us.
+    """
+    code = '; '.join('import {}'.format(name) for name in module_names)
+    proc = subprocess.run([python, '-X', 'importtime', '-c', code], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise Exception('import_time_report(): import failed:\n{}'.format(proc.stderr))
+    if 'import time:' not in proc.stderr:  # older interpreters silently ignore unknown -X options
+        raise Exception('import_time_report(): {} printed no "-X importtime" report, '
+                        'it needs Python 3.7+'.format(python))
+
+    rows, total_us = [], 0
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)', line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((int(cumulative_us), int(self_us), name.strip()))
+            if not indent:  # top-level imports only, so nested modules aren't double-counted
+                total_us += int(cumulative_us)
+    return sorted(rows, reverse=True)[:top], total_us
+
+
+# run from parse_server/ as:  python -m utils.lazy_import webparser [more modules...]
+if __name__ == '__main__':
+    modules = sys.argv[1:] or ['webparser']
+    report, total = import_time_report(modules)
+    print('Import cost for {}: {:.1f}ms total\n'.format(', '.join(modules), total / 1000.0))
+    print('{:>12} {:>12}  {}'.format('cumulative', 'self', 'module'))
+    for cumulative_us, self_us, module_name in report:
+        print('{:>10.1f}ms {:>10.1f}ms  {}'.format(cumulative_us / 1000.0, self_us / 1000.0, module_name))
@@ -3,25 +3,30 @@ import fcntl
 import struct
 import array
 import sys
+import threading
+import time
+import traceback
 
+SIOCGIFCONF = 0x8912
+IFREQ_SIZE = 40 if (sys.maxsize > 2 ** 32) else 32  # test for 64-bit
 
-def get_net_interfaces():
+# netlink multicast groups for link and address changes (see linux/rtnetlink.h)
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+
+def _ioctl_ipv4_addresses():
     """
-    Adapted from original all_interfaces() code below, with the following changes:
-    - returns 'interfaces' dict instead of 'ifaces' list
-    - uses Python 3.x context manager for socket(), to auto-close afterward
-    - uses /dev/zero to initialize array (not sure, might be up to 2x as fast?)
-    - uses newer .tobytes() instead of deprecated .tostring()
+    Returns [(interface name, IPv4 address)] via SIOCGIFCONF.  The buffer starts with room for 8
+    interfaces and doubles until the kernel's answer fits (zero-filled in one allocation per try).
     """
-    struct_size = 40 if (sys.maxsize > 2 ** 32) else 32  # test for 64-bit
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
         max_possible = 8  # initial value
         while True:
-            _bytes = max_possible * struct_size
-            names = array.array('B')
-            with open('/dev/zero', 'rb') as zr0:
-                names.fromfile(zr0, _bytes)
-            outbytes = struct.unpack('iL', fcntl.ioctl(s.fileno(), 0x8912,  # SIOCGIFCONF
+            _bytes = max_possible * IFREQ_SIZE
+            names = array.array('B', bytes(_bytes))
+            outbytes = struct.unpack('iL', fcntl.ioctl(s.fileno(), SIOCGIFCONF,
                                                        struct.pack('iL', _bytes, names.buffer_info()[0])))[0]
             if outbytes == _bytes:
                 max_possible *= 2
@@ -29,41 +34,152 @@ def get_net_interfaces():
                 break
 
     name_str = names.tobytes()
-    interfaces = {}
-    for i in range(0, outbytes, struct_size):
-        ifc_name = bytes.decode(name_str[i:i + 16]).split('\0', 1)[0]
-        ifc_addr = socket.inet_ntoa(name_str[i + 20:i + 24])
-        interfaces[ifc_name] = ifc_addr
+    return [(name_str[i:i + 16].split(b'\0', 1)[0].decode(), socket.inet_ntoa(name_str[i + 20:i + 24]))
+            for i in range(0, outbytes, IFREQ_SIZE)]
 
+
+def _proc_ipv6_addresses(proc_file='/proc/net/if_inet6'):
+    """ Returns [(interface name, IPv6 address)] from /proc (Linux), or [] if unavailable. """
+    addresses = []
+    try:
+        with open(proc_file) as infile:
+            for line in infile:
+                fields = line.split()
+                if len(fields) >= 6:
+                    addr = socket.inet_ntop(socket.AF_INET6, bytes.fromhex(fields[0]))
+                    addresses.append((fields[5], addr))
+    except OSError:
+        pass
+    return addresses
+
+
+def enumerate_interfaces():
+    """ Returns {name: {'index': int, 'ipv4': [addresses], 'ipv6': [addresses]}} for all interfaces. """
+    interfaces = {}
+    try:
+        for index, name in socket.if_nameindex():
+            interfaces[name] = {'index': index, 'ipv4': [], 'ipv6': []}
+    except OSError:
+        pass
+    for family, addresses in (('ipv4', _ioctl_ipv4_addresses()), ('ipv6', _proc_ipv6_addresses())):
+        for name, addr in addresses:
+            info = interfaces.setdefault(name, {'index': None, 'ipv4': [], 'ipv6': []})
+            if addr not in info[family]:
+                info[family].append(addr)
     return interfaces
 
 
+class InterfaceRegistry(object):
+    """
+    Cached view of the network interfaces: enumerated once, then refreshed only when a netlink
+    link/address event arrives (or, where netlink is unavailable, when the cache is older than ttl).
+    Lookups are plain dict reads, so callers (server binding, diagnostics) can call them freely.
+    Watchers are called as callback(old_interfaces, new_interfaces) after each change.
+    """
+
+    def __init__(self, ttl=60.0, use_netlink=True):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._watchers = []
+        self._interfaces = {}
+        self._refreshed_at = 0.0
+        self._netlink_thread = None
+        self.refresh()
+        if use_netlink:
+            self._start_netlink()
+
+    @property
+    def uses_netlink(self):
+        return self._netlink_thread is not None
+
+    def _start_netlink(self):
+        try:
+            nl_sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            nl_sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        except (AttributeError, OSError):  # not Linux, or not permitted: fall back to ttl refresh
+            return
+        self._netlink_thread = threading.Thread(target=self._netlink_loop, args=(nl_sock,),
+                                                name='netlink-watcher', daemon=True)
+        self._netlink_thread.start()
+
+    def _netlink_loop(self, nl_sock):
+        with nl_sock:
+            while True:
+                try:
+                    nl_sock.recv(65536)
+                    # changes usually arrive in bursts (link up, then each address), so coalesce them
+                    nl_sock.settimeout(0.05)
+                    try:
+                        while True:
+                            nl_sock.recv(65536)
+                    except socket.timeout:
+                        pass
+                    nl_sock.settimeout(None)
+                    self.refresh()
+                except Exception as e:
+                    print('*** InterfaceRegistry: netlink watcher stopped ({}), using ttl refresh'.format(e))
+                    self._netlink_thread = None  # back to ttl refresh
+                    return
+
+    def watch(self, callback):
+        self._watchers.append(callback)
+        return callback
+
+    def unwatch(self, callback):
+        if callback in self._watchers:
+            self._watchers.remove(callback)
+
+    def refresh(self):
+        with self._lock:
+            new_interfaces = enumerate_interfaces()
+            old_interfaces, self._interfaces = self._interfaces, new_interfaces
+            self._refreshed_at = time.time()
+        if old_interfaces and old_interfaces != new_interfaces:
+            for callback in list(self._watchers):
+                try:  # a failing watcher must not stop the netlink thread, or the other watchers
+                    callback(old_interfaces, new_interfaces)
+                except Exception:
+                    print('*** InterfaceRegistry: watcher {!r} failed:'.format(callback))
+                    traceback.print_exc()
+        return new_interfaces
+
+    def interfaces(self):
+        if not self.uses_netlink and time.time() - self._refreshed_at > self.ttl:
+            return self.refresh()
+        return self._interfaces
+
+    def get(self, name, default=None):
+        return self.interfaces().get(name, default)
+
+    def addresses(self, name, family='ipv4'):
+        info = self.interfaces().get(name)
+        return list(info[family]) if info else []
+
+    def ipv4_map(self):
+        """ Returns {name: first IPv4 address}, like get_net_interfaces() always has. """
+        return {name: info['ipv4'][0] for name, info in self.interfaces().items() if info['ipv4']}
+
+
+_REGISTRY = None
+
+
+def get_interface_registry():
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = InterfaceRegistry()
+    return _REGISTRY
+
+
+def get_net_interfaces():
+    """
+    Returns 'interfaces' dict of {name: IPv4 address}, from the cached InterfaceRegistry
+    (use get_interface_registry() directly for IPv6 addresses, or to watch for changes).
+    """
+    return get_interface_registry().ipv4_map()
+
+
 # Original version of get_network_interfaces() function, created by various developers at
 # http://code.activestate.com/recipes/439093-get-names-of-all-up-network-interfaces-linux-only/?in=user-2551140
+# (now just returns the same SIOCGIFCONF results, as a list of (name, address) tuples)
 def all_interfaces():
-    is_64bits = sys.maxsize > 2**32
-    struct_size = 40 if is_64bits else 32
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    max_possible = 8 # initial value
-    while True:
-        _bytes = max_possible * struct_size
-        names = array.array('B')
-        for i in range(0, _bytes):
-            names.append(0)
-        outbytes = struct.unpack('iL', fcntl.ioctl(
-            s.fileno(),
-            0x8912,  # SIOCGIFCONF
-            struct.pack('iL', _bytes, names.buffer_info()[0])
-        ))[0]
-        if outbytes == _bytes:
-            max_possible *= 2
-        else:
-            break
-    namestr = names.tostring()
-    ifaces = []
-    for i in range(0, outbytes, struct_size):
-        iface_name = bytes.decode(namestr[i:i+16]).split('\0', 1)[0]
-        iface_addr = socket.inet_ntoa(namestr[i+20:i+24])
-        ifaces.append((iface_name, iface_addr))
-
-    return ifaces
+    return _ioctl_ipv4_addresses()
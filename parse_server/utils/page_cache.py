@@ -0,0 +1,99 @@
+import hashlib
+import shelve
+import time
+from collections import OrderedDict
+
+
+def page_digest(page_url, page_source):
+    """
+    Returns the cache key for a submitted page: the page_url plus a digest of its page_source.
+    (blake2b is much faster than sha256 on large pages, and 16 bytes is plenty for de-duplication.)
+    """
+    source_bytes = page_source.encode('utf-8', 'surrogatepass') if isinstance(page_source, str) else page_source
+    return '{}#{}'.format(page_url, hashlib.blake2b(source_bytes, digest_size=16).hexdigest())
+
+
+class PageCache(object):
+    """
+    LRU + TTL cache of recently-seen page submissions, so that identical POSTs to /webparser
+    (tab refresh, double-click on the popup) are acknowledged without re-running the siteparsers.
+
+    Only the key and a timestamp are stored per entry (never the page_source itself), so memory
+    use is bounded by max_entries.  If persist_file is given, entries are saved to a shelve on
+    close() and re-loaded at startup, so the cache survives a server restart.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, persist_file=None):
+        self.max_entries = max_entries
+        self.ttl = ttl  # in seconds, or None/0 to never expire
+        self.persist_file = persist_file
+        self._entries = OrderedDict()  # key=page_digest(), value=time last seen
+        self.hits = 0
+        self.misses = 0
+        if persist_file:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        seen_at = self._entries.get(key, None)
+        return seen_at is not None and not self._is_expired(seen_at, time.time())
+
+    def _is_expired(self, seen_at, now):
+        return bool(self.ttl) and (now - seen_at) > self.ttl
+
+    def check_and_add(self, key):
+        """
+        Returns True if key was already in the (unexpired) cache, otherwise adds it and returns False.
+        Either way, the key becomes the most-recently-used entry.
+        """
+        now = time.time()
+        seen_at = self._entries.pop(key, None)
+        is_hit = seen_at is not None and not self._is_expired(seen_at, now)
+        if is_hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._entries[key] = now
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)  # evict least-recently-used
+
+        return is_hit
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hit_rate, 4)}
+
+    def load(self):
+        now = time.time()
+        with shelve.open(self.persist_file, protocol=4) as db:
+            saved = sorted(db.get('entries', {}).items(), key=lambda item: item[1])
+        for key, seen_at in saved[-self.max_entries:]:
+            if not self._is_expired(seen_at, now):
+                self._entries[key] = seen_at
+
+    def save(self):
+        if self.persist_file:
+            with shelve.open(self.persist_file, protocol=4) as db:
+                db['entries'] = dict(self._entries)
+
+    def close(self):
+        self.save()
@@ -0,0 +1,92 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from urllib.parse import urlsplit
+
+
+class RequestProfiler(object):
+    """
+    Decides which requests to profile (a random sample_rate fraction, plus any request carrying the
+    header, if allow_header is enabled in the config), and where their profile files go.  Either way,
+    at most max_per_minute requests are profiled, and only the newest max_files profiles are kept, so
+    neither a client nor a high sample_rate can make the server profile every page or fill the disk.
+    """
+
+    def __init__(self, output_dir='../_data/profiles', sample_rate=0.0, allow_header=False,
+                 header_name='X-Divia-Profile', max_per_minute=6, max_files=200):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.allow_header = allow_header
+        self.header_name = header_name
+        self.max_per_minute = max_per_minute
+        self.max_files = max_files
+        self._recent = deque()  # times of the profiled requests in the last minute
+        self._lock = threading.Lock()
+
+    def should_profile(self, header_value=None):
+        if self.allow_header and header_value and header_value.strip().lower() not in ('0', 'false', 'no', 'off'):
+            wanted = True
+        else:
+            wanted = self.sample_rate > 0 and random.random() < self.sample_rate
+        return wanted and self._take_slot()
+
+    def _take_slot(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > 60.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_per_minute:
+                return False
+            self._recent.append(now)
+        self.prune()
+        return True
+
+    def prune(self):
+        """ Removes the oldest profiles (each a .prof + .txt pair) beyond the newest max_files. """
+        try:
+            filenames = [f for f in os.listdir(self.output_dir) if f.endswith(('.prof', '.txt'))]
+        except OSError:
+            return
+        stems = sorted({os.path.splitext(f)[0] for f in filenames}, reverse=True)  # names start with a timestamp
+        for stem in stems[self.max_files:]:
+            for ext in ('.prof', '.txt'):
+                try:
+                    os.remove(os.path.join(self.output_dir, stem + ext))
+                except OSError:
+                    pass
+
+    def profile_path(self, parser_name, page_url):
+        """ Returns the path prefix (no extension) for one parser's profile of one page. """
+        os.makedirs(self.output_dir, exist_ok=True)
+        host = urlsplit(page_url).hostname or 'unknown'
+        tag = '{}_{}_{}'.format(datetime.now().strftime('%Y%m%d_%H%M%S_%f'), parser_name, host)
+        return os.path.join(self.output_dir, re.sub(r'[^A-Za-z0-9_.-]+', '-', tag))
+
+
+def run_profiled(profile_path, page_url, fn, *args, **kwargs):
+    """
+    Calls fn(*args, **kwargs) under cProfile, then writes '<profile_path>_<ms>ms.prof' (pstats,
+    for snakeviz/pstats.Stats) and a matching '.txt' summary with the page_url and top functions.
+    """
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        filename = '{}_{}ms'.format(profile_path, int(elapsed_ms))
+        profiler.dump_stats(filename + '.prof')
+
+        summary = io.StringIO()
+        summary.write('page_url: {}\nelapsed: {:.1f}ms\n\n'.format(page_url, elapsed_ms))
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(30)
+        with open(filename + '.txt', 'w', encoding='utf-8') as outfile:
+            outfile.write(summary.getvalue())
+        print('- profile saved: {}.prof ({:.1f}ms)'.format(filename, elapsed_ms))
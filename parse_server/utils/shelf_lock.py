@@ -0,0 +1,240 @@
+import dbm
+import fcntl
+import json
+import os
+import pickletools
+import shutil
+import time
+from glob import glob
+
+
+class ShelfCoordinator(object):
+    """
+    Multi-process coordination for a set of shelve files in one directory:
+
+    - single writer: an flock()'d writer lock file (released by the kernel if the writer crashes)
+    - many readers: the shelf files are copied into a new snapshot generation, and readers open the
+      latest generation read-only, so they never see a half-written dbm file and never block the writer
+    - snapshots are not copied on every writer close (that costs I/O proportional to the whole database
+      per page), but at most every publish_interval seconds, or on demand when a reader finds the latest
+      snapshot older than that and the shelves have changed since
+    - stale-lock recovery: the writer marks the shelves 'open' while it holds them, so if the next writer
+      finds that mark (previous writer died, e.g. killed on a parser timeout), it checks that the live
+      shelves still open and read back cleanly, and only restores them from the latest snapshot if not
+      (the snapshot can be up to publish_interval behind, so restoring would drop clean commits)
+    """
+
+    def __init__(self, dir_path, db_names, keep_snapshots=1, publish_interval=300.0):
+        self.dir_path = dir_path
+        self.db_names = list(db_names)
+        self.keep_snapshots = keep_snapshots      # besides these, older generations still pinned by readers
+        self.publish_interval = publish_interval  # max snapshot age (seconds) before a writer re-publishes
+        self.lock_path = os.path.join(dir_path, 'db.writer.lock')
+        self.state_path = os.path.join(dir_path, 'db.writer.state')
+        self.snapshot_root = os.path.join(dir_path, 'db_snapshots')
+        self._writer_fd = None
+        self._reader_fd = None
+        self._unpublished = False
+
+    # -------------------------------------------------------------------
+    #  Writer side
+    # -------------------------------------------------------------------
+    def acquire_writer(self, timeout=30.0):
+        os.makedirs(self.dir_path, exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    os.close(fd)
+                    raise Exception('ShelfCoordinator: writer lock busy after {}s: {}'.format(timeout, self._read_state()))
+                time.sleep(0.05)
+        self._writer_fd = fd
+
+        state = self._read_state()
+        if state.get('state') == 'open':
+            print('*** ShelfCoordinator: previous writer (pid {}) did not close cleanly'.format(state.get('pid')))
+            bad_names = self.verify_shelves()
+            if bad_names:
+                print('*** ShelfCoordinator: shelves {} fail to read back'.format(bad_names))
+                self.restore_latest_snapshot()
+                state['unpublished'] = False
+            else:
+                state['unpublished'] = True  # keep them, but they may differ from the latest snapshot
+        self._unpublished = state.get('unpublished', False)
+        self._write_state('open')
+
+    def release_writer(self, publish=True):
+        """
+        Call after the shelves are closed (synced), to release the lock.  With publish=True, the
+        shelves have changed: a snapshot is published if the latest one is older than publish_interval,
+        otherwise it is just marked stale (publish='force' always publishes).
+        """
+        if self._writer_fd is None:
+            return
+        try:
+            unpublished = self._unpublished or bool(publish)
+            if publish == 'force' or (unpublished and self.snapshot_age() >= self.publish_interval):
+                self.publish_snapshot()
+                unpublished = False
+            self._write_state('clean', unpublished=unpublished)
+        finally:
+            fcntl.flock(self._writer_fd, fcntl.LOCK_UN)
+            os.close(self._writer_fd)
+            self._writer_fd = None
+
+    def _read_state(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, state, unpublished=None):
+        if unpublished is None:
+            unpublished = self._unpublished
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as outfile:
+            json.dump({'pid': os.getpid(), 'state': state, 'since': time.time(), 'unpublished': unpublished}, outfile)
+        os.replace(tmp_path, self.state_path)
+
+    def snapshot_age(self):
+        """ Seconds since the latest snapshot was published (infinite if there is none). """
+        try:
+            return time.time() - os.stat(os.path.join(self.snapshot_root, 'CURRENT')).st_mtime
+        except OSError:
+            return float('inf')
+
+    def _db_files(self, dir_path):
+        return [f for db_name in self.db_names for f in glob(os.path.join(dir_path, db_name) + '*')]
+
+    def publish_snapshot(self):
+        """ Copies the (closed) shelf files into a new snapshot generation, then points CURRENT at it. """
+        os.makedirs(self.snapshot_root, exist_ok=True)
+        generation = self._current_generation() + 1
+        gen_dir = os.path.join(self.snapshot_root, 'gen-{}'.format(generation))
+        tmp_dir = gen_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for db_file in self._db_files(self.dir_path):
+            shutil.copy2(db_file, tmp_dir)
+        open(os.path.join(tmp_dir, '.readers.lock'), 'w').close()
+        os.rename(tmp_dir, gen_dir)
+
+        current_tmp = os.path.join(self.snapshot_root, 'CURRENT.tmp')
+        with open(current_tmp, 'w') as outfile:
+            outfile.write(str(generation))
+        os.replace(current_tmp, os.path.join(self.snapshot_root, 'CURRENT'))
+        self._cleanup_snapshots(generation)
+        return gen_dir
+
+    def _current_generation(self):
+        try:
+            with open(os.path.join(self.snapshot_root, 'CURRENT')) as infile:
+                return int(infile.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    def _cleanup_snapshots(self, current):
+        for gen_dir in glob(os.path.join(self.snapshot_root, 'gen-*')):
+            try:
+                generation = int(os.path.basename(gen_dir)[4:])
+            except ValueError:
+                continue
+            if generation > current - self.keep_snapshots:
+                continue
+            with open(os.path.join(gen_dir, '.readers.lock'), 'a') as lock_file:
+                try:  # only delete generations that no reader still has open
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(gen_dir, ignore_errors=True)
+
+    def verify_shelves(self):
+        """
+        Returns the names of the live shelves that don't open, or don't read back every record as a
+        complete pickle.  (Values are only walked with pickletools, not unpickled, so no classes are imported.)
+        """
+        bad_names = []
+        for db_name in self.db_names:
+            db_path = os.path.join(self.dir_path, db_name)
+            db_type = dbm.whichdb(db_path)
+            if db_type is None and not glob(db_path + '*'):
+                continue  # not created yet
+            try:
+                if not db_type:
+                    raise Exception('unrecognized dbm format')
+                with dbm.open(db_path, 'r') as db:
+                    for key in db.keys():
+                        for _ in pickletools.genops(db[key]):
+                            pass
+            except Exception:
+                bad_names.append(db_name)
+        return bad_names
+
+    def restore_latest_snapshot(self):
+        generation = self._current_generation()
+        gen_dir = os.path.join(self.snapshot_root, 'gen-{}'.format(generation))
+        if not generation or not os.path.isdir(gen_dir):
+            print('*** ShelfCoordinator: no snapshot to restore from, keeping shelves as-is')
+            return False
+        for db_file in self._db_files(self.dir_path):
+            os.remove(db_file)
+        for db_file in self._db_files(gen_dir):
+            shutil.copy2(db_file, self.dir_path)
+        print('- ShelfCoordinator: restored shelves from snapshot gen-{}'.format(generation))
+        return True
+
+    # -------------------------------------------------------------------
+    #  Reader side
+    # -------------------------------------------------------------------
+    def _refresh_snapshot(self, max_age):
+        # on-demand publish for a reader: only if the shelves changed since the snapshot, and only if
+        # the writer lock is free right now (otherwise the reader just uses the existing snapshot)
+        if self._current_generation() and (self.snapshot_age() < max_age or
+                                           not self._read_state().get('unpublished')):
+            return
+        try:
+            self.acquire_writer(timeout=0.5 if self._current_generation() else 30.0)
+        except Exception:
+            return
+        try:
+            if not self._current_generation() or self._unpublished:
+                self.publish_snapshot()
+                self._unpublished = False
+        finally:
+            self.release_writer(publish=False)
+
+    def acquire_reader(self, retries=5, max_age=None):
+        """
+        Pins the latest snapshot generation (shared lock, so it won't be cleaned up while in use) and
+        returns its directory.  If no snapshot exists yet, or it is older than max_age (default
+        publish_interval) and the shelves have changed since, briefly takes the writer lock to publish one.
+        """
+        self._refresh_snapshot(self.publish_interval if max_age is None else max_age)
+        for _ in range(retries):
+            generation = self._current_generation()
+            if not generation:
+                self._refresh_snapshot(0)
+                continue
+
+            gen_dir = os.path.join(self.snapshot_root, 'gen-{}'.format(generation))
+            try:
+                fd = os.open(os.path.join(gen_dir, '.readers.lock'), os.O_RDONLY)
+            except FileNotFoundError:
+                continue  # cleaned up between reading CURRENT and pinning it, so try again
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            if not os.path.isdir(gen_dir):
+                os.close(fd)
+                continue
+            self._reader_fd = fd
+            return gen_dir
+        raise Exception('ShelfCoordinator: could not pin a snapshot in {}'.format(self.snapshot_root))
+
+    def release_reader(self):
+        if self._reader_fd is not None:
+            os.close(self._reader_fd)  # closing the fd releases its flock
+            self._reader_fd = None
@@ -1,32 +1,43 @@
 #!/usr/bin/env python3.6
 import os
-import importlib
+import atexit
 import json
-import re
 
 import bottle
 
 # TODO: Should this be in Config setting?
 bottle.BaseRequest.MEMFILE_MAX = 10 * 1024 * 1024  # 10MB in bytes
-from bottle import route, run, template, get, post, request
+from bottle import route, run, template, get, post, request, response, abort
+
+from parser_scheduler import ParserScheduler
+from siteparsers.eztv_export import TABLE_COLUMNS, stream_table, parse_date
+from utils.page_cache import PageCache, page_digest
+from utils.lazy_import import lazy_import
+from utils.network_utils import get_interface_registry
+from utils.profiling import RequestProfiler
+
+
+def load_siteparsers_config():
+    with open('./siteparsers/siteparsers.json', encoding='utf-8') as config_file:
+        return json.load(config_file)
 
 
 # function to programmatically load siteparser modules as URL handlers
-def load_siteparsers_map():
+def load_siteparsers_map(config_data=None):
 
     # TODO: Rewrite Siteparsers logic to use metaclass with singleton factory,
     # TODO: so that, only a single instance is created for each class, on-demand.
     # TODO: Then use shelve() to save/cache objects for much faster load/reload.
     # TODO: Use the reload-on-changed (like .pyc) logic from the new Config system.
 
-    with open('./siteparsers/siteparsers.json', encoding='utf-8') as config_file:
-        config_data = json.load(config_file)
+    if config_data is None:
+        config_data = load_siteparsers_config()
 
-    # parse JSON config file to dynamically import handler modules
+    # parse JSON config file to dynamically (and lazily, on first use) import handler modules
     siteparsers_map = {}
     for url_match, handler in config_data.items():
         module_name = 'siteparsers.' + os.path.splitext(handler['parser'])[0]
-        siteparsers_map[url_match] = importlib.import_module(module_name)
+        siteparsers_map[url_match] = lazy_import(module_name)
 
 
     LATER_OPTIMIZATION_COMPILE_REGEXP_AND_ADD_PREFIX_POSTFIX_FOR_FULLMATCH = """
@@ -41,7 +52,21 @@ def load_siteparsers_map():
     return siteparsers_map
 
 
-SITEPARSERS_MAP = load_siteparsers_map()
+SITEPARSERS_CONFIG = load_siteparsers_config()
+SITEPARSERS_MAP = load_siteparsers_map(SITEPARSERS_CONFIG)
+
+# runs matching handlers by priority, with per-parser timeouts and concurrency caps (see siteparsers.json)
+PARSER_SCHEDULER = ParserScheduler.from_config(SITEPARSERS_CONFIG, SITEPARSERS_MAP)
+atexit.register(PARSER_SCHEDULER.shutdown)
+
+# short-circuit cache for identical page submissions (tab refresh, double-click on popup, etc.)
+# TODO: Should these be in Config settings too?
+PAGE_CACHE = PageCache(max_entries=4096, ttl=3600, persist_file=os.path.join('../_data', 'page_cache'))
+atexit.register(PAGE_CACHE.close)
+
+# opt-in cProfile of the handler chain: a random sample, plus requests with the X-Divia-Profile header (only if
+# parse_server.profile_allow_header is set), rate-limited and pruned (see the parse_server.profile_* settings)
+REQUEST_PROFILER = RequestProfiler(output_dir=os.path.join('../_data', 'profiles'), sample_rate=0.0)
 
 
 @route('/hello/<name>')
@@ -63,11 +88,52 @@ def webparser_info():
 @post('/webparser')
 def parse_webpage():
     data = request.json
-    for regex, handler in SITEPARSERS_MAP.items():
-        if re.search(regex, data['page_url']):
-            handler.parse_json(data)
 
-    return json.dumps({'success': True})
+    profile_header = request.get_header(REQUEST_PROFILER.header_name)
+    profile_request = REQUEST_PROFILER.should_profile(profile_header)
+
+    # identical page already parsed recently, so only the cheap skip_on_cache_hit=False handlers (tracker)
+    # run again ...unless this request is profiled, which needs the full parse to run
+    cache_key = page_digest(data['page_url'], data['page_source'])
+    cache_hit = PAGE_CACHE.check_and_add(cache_key) and not profile_request
+
+    # handlers still queued/running after their request_wait finish in the background; if one of those fails
+    # later, the page is dropped from the cache too, so that re-sending the page will retry the parse
+    results = PARSER_SCHEDULER.dispatch(data, profiler=REQUEST_PROFILER if profile_request else None,
+                                        cache_hit=cache_hit,
+                                        on_background_failure=lambda parser_name: PAGE_CACHE.discard(cache_key))
+    success = all(result['status'] in ('ok', 'queued', 'running') for result in results)
+    if not success:
+        PAGE_CACHE.discard(cache_key)
+
+    return json.dumps({'success': success, 'cached': cache_hit, 'parsers': results})
+
+
+@get('/eztv/export/<table>')
+def eztv_export(table):
+    # e.g. /eztv/export/files?format=csv&show=Some+Show&since=2017-06-01&resolution=720p&watermark=1497000000.0
+    fmt = request.query.get('format', 'ndjson')
+    if table not in TABLE_COLUMNS or fmt not in ('ndjson', 'csv'):
+        abort(400, 'Unknown table or format')
+
+    filters = {'shows': request.query.getall('show') or None}
+    if table == 'files':
+        watermark = request.query.get('watermark')
+        try:
+            filters.update(since=parse_date(request.query.get('since')),
+                           until=parse_date(request.query.get('until')),
+                           resolution=request.query.get('resolution'),
+                           watermark=float(watermark) if watermark else None)
+        except ValueError:
+            abort(400, 'Invalid since/until (expected YYYY-MM-DD) or watermark (expected a timestamp)')
+
+    response.content_type = 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv'
+    return stream_table(table, fmt, **filters)
+
+
+@get('/webparser/cache')
+def page_cache_stats():
+    return json.dumps(PAGE_CACHE.stats())
 
 
 # main() entry point
@@ -79,6 +145,38 @@ if __name__ == '__main__':
     from divia_config.webparser import DevelopmentConfig
     settings = DevelopmentConfig(debug=True)
 
+    # live-tunable settings: re-applied when the config JSON changes on disk, without a restart
+    def update_memfile_max(key, old_value, new_value):
+        if new_value:
+            bottle.BaseRequest.MEMFILE_MAX = int(new_value)
+            print('- config: {} changed from {} to {}'.format(key, old_value, new_value))
+
+    def update_profiler(key=None, old_value=None, new_value=None):
+        sample_rate, allow_header, max_per_minute, max_files = settings.parse_server(
+            'profile_sample_rate', 'profile_allow_header', 'profile_max_per_minute', 'profile_max_files')
+        REQUEST_PROFILER.sample_rate = float(sample_rate or 0.0)
+        REQUEST_PROFILER.allow_header = bool(allow_header)
+        if max_per_minute is not None:
+            REQUEST_PROFILER.max_per_minute = int(max_per_minute)
+        if max_files is not None:
+            REQUEST_PROFILER.max_files = int(max_files)
+        if key:
+            print('- config: {} changed from {} to {}'.format(key, old_value, new_value))
+
+    update_profiler()
+    settings.watch('parse_server.memfile_max', update_memfile_max)
+    for profile_key in ('profile_sample_rate', 'profile_allow_header', 'profile_max_per_minute', 'profile_max_files'):
+        settings.watch('parse_server.' + profile_key, update_profiler)
+    settings.start_watching()
+
+    # import and compile the siteparsers now, so the first request doesn't pay for it
+    PARSER_SCHEDULER.prewarm()
+    PARSER_SCHEDULER.start_background()
+
     host, port = settings.parse_server('host', 'port')
+    local_addresses = {addr for info in get_interface_registry().interfaces().values()
+                       for addr in info['ipv4'] + info['ipv6']}
+    if host not in local_addresses and host not in ('0.0.0.0', '::', 'localhost'):
+        print('*** Warning: host {!r} is not an address of any local interface'.format(host))
     run(host=host, port=port)
 